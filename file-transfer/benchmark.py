@@ -0,0 +1,463 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+'''
+loopback benchmarks for file-transfer.py, the server always runs in its own
+process so it does not share the event loop with the client side
+
+python benchmark.py sendfile [-m SIZE_MB] [-r ROUNDS]
+python benchmark.py pget [-m SIZE_MB] [-r ROUNDS] [-n 1 2 4 8]
+python benchmark.py tree [-n FILES] [-k SIZE_KB]
+python benchmark.py writeback [-m SIZE_MB] [-r ROUNDS] [--tmpfs DIR] [--disk DIR]
+python benchmark.py load [-w 1 2 4] [-c CONNECTIONS] [-p PROCS] [-t SECONDS] [-z]
+python benchmark.py hash [-m SIZE_MB] [-r ROUNDS]
+python benchmark.py fairness [-b BIG_CLIENTS] [-m SIZE_MB] [-k SIZE_KB] [--rate MB]
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "file-transfer.py")
+
+ft = importlib.import_module("file-transfer")
+
+MB = 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((ft.CLIENT_DFT_IP, 0))
+        return s.getsockname()[1]
+
+
+def make_file(path, size):
+    block = os.urandom(MB)
+    with open(path, "wb") as f:
+        n = 0
+        while n < size:
+            n += f.write(block[:min(MB, size - n)])
+
+
+@contextlib.contextmanager
+def server_process(root, *extra):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, SCRIPT, "-s", str(port), *extra],
+                            cwd=root, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection((ft.CLIENT_DFT_IP, port)).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.05)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null),\
+            contextlib.redirect_stderr(null):
+        yield
+
+
+async def download(port, index, digest=True):
+    reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port, digest=digest)
+    with quiet():
+        await ft.list_request(reader, writer)
+        start = time.perf_counter()
+        await ft.get_request(reader, writer, index)
+        cost = time.perf_counter() - start
+    ft.close_request(writer)
+    return cost
+
+
+def report(name, size, costs):
+    best = min(costs)
+    avg = sum(costs) / len(costs)
+    print(f"{name:<20} best {size / MB / best:8.1f} MB/s   "
+          f"avg {size / MB / avg:8.1f} MB/s")
+
+
+def bench_sendfile(args):
+    size = args.size * MB
+    with tempfile.TemporaryDirectory() as src,\
+            tempfile.TemporaryDirectory() as dst:
+        make_file(os.path.join(src, "payload.bin"), size)
+        os.chdir(dst)
+        for name, extra in (("sendfile", ()), ("chunked", ("--no-sendfile",))):
+            # the transfer alone, bench_hash measures what digests add
+            with server_process(src, *extra) as port:
+                costs = [asyncio.run(download(port, 1, digest=False))
+                         for _ in range(args.rounds)]
+            report(name, size, costs)
+        os.chdir(HERE)
+
+
+async def parallel_download(port, filename, streams):
+    with quiet():
+        start = time.perf_counter()
+        await ft.parallel_get_request(ft.CLIENT_DFT_IP, port, filename, streams)
+        return time.perf_counter() - start
+
+
+def bench_pget(args):
+    size = args.size * MB
+    with tempfile.TemporaryDirectory() as src,\
+            tempfile.TemporaryDirectory() as dst:
+        make_file(os.path.join(src, "payload.bin"), size)
+        os.chdir(dst)
+        with server_process(src) as port:
+            for streams in args.streams:
+                costs = [asyncio.run(parallel_download(port, "payload.bin",
+                                                       streams))
+                         for _ in range(args.rounds)]
+                report(f"{streams} streams", size, costs)
+        os.chdir(HERE)
+
+
+def make_tree(root, count, size):
+    os.makedirs(root)
+    for i in range(count):
+        folder = os.path.join(root, f"d{i // 1000}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"f{i}.dat"), "wb") as f:
+            f.write(os.urandom(size))
+
+
+async def timed(coro):
+    with quiet():
+        start = time.perf_counter()
+        await coro
+        return time.perf_counter() - start
+
+
+async def tree_round(port, src, dst, count, size):
+    reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port)
+    tree = os.path.join(src, "tree")
+    paths = sorted(os.path.join(dirpath, fn)
+                   for dirpath, _, fns in os.walk(tree) for fn in fns)
+    total = count * size
+
+    # with the digest negotiated every SEND returns once the server
+    # acknowledged it, all of it landed
+    async def send_each():
+        for path in paths:
+            await ft.send_request(reader, writer, path)
+
+    async def get_each():
+        files = await ft.list_request(reader, writer)
+        for index, name in enumerate(files, 1):
+            if name.endswith(".dat"):
+                await ft.get_request(reader, writer, index)
+
+    async def send_big():
+        await ft.send_request(reader, writer, os.path.join(src, "big.dat"))
+
+    os.chdir(src)
+    results = [("send each", await timed(send_each())),
+               ("send -r", await timed(
+                   ft.send_tree_request(reader, writer, tree)))]
+    os.chdir(dst)
+    results += [("get each", await timed(get_each())),
+                ("get -r", await timed(
+                    ft.get_tree_request(reader, writer, "tree")))]
+    os.chdir(src)
+    results.append(("one file", await timed(send_big())))
+    ft.close_request(writer)
+    for name, cost in results:
+        print(f"{name:<12} {count / cost:10.0f} files/s "
+              f"{total / MB / cost:8.1f} MB/s")
+
+
+def bench_tree(args):
+    size = args.size * 1024
+    with tempfile.TemporaryDirectory() as src,\
+            tempfile.TemporaryDirectory() as srv,\
+            tempfile.TemporaryDirectory() as dst:
+        make_tree(os.path.join(src, "tree"), args.files, size)
+        make_file(os.path.join(src, "big.dat"), args.files * size)
+        with server_process(srv) as port:
+            asyncio.run(tree_round(port, src, dst, args.files, size))
+        os.chdir(HERE)
+
+
+async def upload(port, path, digest=True):
+    reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port, digest=digest)
+    with quiet():
+        start = time.perf_counter()
+        await ft.send_request(reader, writer, path)
+        # without a digest SEND is not acknowledged, STAT is only served once
+        # it is written
+        await ft.stat_request(reader, writer, os.path.basename(path))
+        cost = time.perf_counter() - start
+    ft.close_request(writer)
+    return cost
+
+
+def bench_writeback(args):
+    size = args.size * MB
+    modes = (("alternate", ("--write-depth", "0")),
+             ("write-behind", ()),
+             ("behind+fsync", ("--fsync-every", "64")))
+    with tempfile.TemporaryDirectory() as src:
+        path = os.path.join(src, "payload.bin")
+        make_file(path, size)
+        for label, base in (("tmpfs", args.tmpfs), ("disk", args.disk)):
+            if not os.path.isdir(base):
+                print(f"skip {label}, {base} is not a directory")
+                continue
+            with tempfile.TemporaryDirectory(dir=base) as dst:
+                for name, extra in modes:
+                    with server_process(dst, *extra) as port:
+                        costs = [asyncio.run(upload(port, path))
+                                 for _ in range(args.rounds)]
+                    report(f"{label} {name}", size, costs)
+
+
+async def get_discard(reader, writer, index):
+    # CMD_GET_FILE without touching the disk on our side
+    ft.write_frame(writer, ft.CommandCode.CMD_GET_FILE, index=index)
+    await writer.drain()
+    await ft.read_frame(reader, ft.CommandCode.CMD_GET_FILE)
+    frame = await ft.read_frame_header(reader, ft.CommandCode.CMD_DATA)
+    n = 0
+    if frame.flags & ft.FLAG_CHUNKED:
+        while n < frame.length:
+            chunk, _ = await ft.read_frame(reader, ft.CommandCode.CMD_CHUNK)
+            n += chunk.index
+    while n < frame.length:
+        data = await reader.read(min(ft.CHUNK_SIZE, frame.length - n))
+        if(not data):
+            raise ConnectionError("connection closed during transfer")
+        n += len(data)
+    if frame.flags & ft.FLAG_DIGEST:
+        await ft.read_frame(reader, ft.CommandCode.CMD_DIGEST)
+
+
+async def load_client(port, connections, seconds, compress):
+    deadline = time.perf_counter() + seconds
+    connect_costs = []
+    transferred = [0]
+
+    async def one():
+        start = time.perf_counter()
+        reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port, compress)
+        connect_costs.append(time.perf_counter() - start)
+        files = await ft.list_request(reader, writer)
+        index = files.index("payload.txt") + 1
+        while time.perf_counter() < deadline:
+            await get_discard(reader, writer, index)
+            transferred[0] += 1
+        ft.close_request(writer)
+
+    with quiet():
+        await asyncio.gather(*(one() for _ in range(connections)))
+    return connect_costs, transferred[0]
+
+
+def load_process(port, connections, seconds, compress, queue):
+    queue.put(asyncio.run(load_client(port, connections, seconds, compress)))
+
+
+def make_text(path, size):
+    line = b'{"ts": 1577836800, "level": "info", "msg": "request done"}\n'
+    with open(path, "wb") as f:
+        f.write(line * (size // len(line) + 1))
+
+
+def bench_load(args):
+    size = args.size * 1024
+    with tempfile.TemporaryDirectory() as src:
+        make_text(os.path.join(src, "payload.txt"), size)
+        size = os.path.getsize(os.path.join(src, "payload.txt"))
+        for workers in args.workers:
+            with server_process(src, "-w", str(workers)) as port:
+                queue = multiprocessing.Queue()
+                per_proc = max(1, args.connections // args.procs)
+                procs = [multiprocessing.Process(
+                    target=load_process,
+                    args=(port, per_proc, args.seconds, args.compress, queue))
+                    for _ in range(args.procs)]
+                for p in procs:
+                    p.start()
+                results = [queue.get(timeout=args.seconds + 60)
+                           for _ in procs]
+                for p in procs:
+                    p.join()
+            costs = sorted(c for r in results for c in r[0])
+            count = sum(r[1] for r in results)
+            p50 = costs[len(costs) // 2] * 1000
+            p99 = costs[min(len(costs) - 1, int(len(costs) * 0.99))] * 1000
+            print(f"{workers} workers: {count / args.seconds:8.0f} req/s "
+                  f"{count * size / MB / args.seconds:8.1f} MB/s   "
+                  f"connect p50 {p50:.1f}ms p99 {p99:.1f}ms")
+
+
+async def big_client(port, connections, seconds):
+    deadline = time.perf_counter() + seconds
+
+    async def one():
+        reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port, digest=False)
+        files = await ft.list_request(reader, writer)
+        index = files.index("big.bin") + 1
+        while time.perf_counter() < deadline:
+            await get_discard(reader, writer, index)
+        ft.close_request(writer)
+
+    with quiet():
+        await asyncio.gather(*(one() for _ in range(connections)))
+
+
+def big_process(port, connections, seconds):
+    asyncio.run(big_client(port, connections, seconds))
+
+
+async def small_latencies(port, seconds):
+    reader, writer = await ft.connect(ft.CLIENT_DFT_IP, port, digest=False)
+    with quiet():
+        files = await ft.list_request(reader, writer)
+    index = files.index("small.bin") + 1
+    costs = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await get_discard(reader, writer, index)
+        costs.append(time.perf_counter() - start)
+        # a trickle of requests, not a load of its own
+        await asyncio.sleep(0.01)
+    ft.close_request(writer)
+    return costs
+
+
+def report_latency(name, costs):
+    costs = sorted(costs)
+    p50 = costs[len(costs) // 2] * 1000
+    p99 = costs[min(len(costs) - 1, int(len(costs) * 0.99))] * 1000
+    print(f"{name:<28} p50 {p50:8.2f}ms   p99 {p99:8.2f}ms   "
+          f"max {costs[-1] * 1000:8.2f}ms")
+
+
+def bench_fairness(args):
+    with tempfile.TemporaryDirectory() as src:
+        make_file(os.path.join(src, "big.bin"), args.size * MB)
+        make_file(os.path.join(src, "small.bin"), args.small * 1024)
+        configs = [("unshaped", ())]
+        if args.rate:
+            configs.append((f"--rate {args.rate}", ("--rate", str(args.rate))))
+        for name, extra in configs:
+            with server_process(src, *extra) as port:
+                report_latency(f"{name}, idle",
+                               asyncio.run(small_latencies(port, args.seconds)))
+                # the big downloads get a process of their own so their
+                # reads do not queue behind ours on one event loop
+                big = multiprocessing.Process(
+                    target=big_process,
+                    args=(port, args.big, args.seconds + 1))
+                big.start()
+                time.sleep(0.5)
+                report_latency(f"{name}, {args.big} big",
+                               asyncio.run(small_latencies(port, args.seconds)))
+                big.join()
+
+
+def hash_rate(name, data, rounds):
+    costs = []
+    for _ in range(rounds):
+        h = ft.DIGESTS[name]()
+        start = time.perf_counter()
+        for i in range(0, len(data), ft.CHUNK_SIZE):
+            h.update(data[i:i + ft.CHUNK_SIZE])
+        h.digest()
+        costs.append(time.perf_counter() - start)
+    return costs
+
+
+def bench_hash(args):
+    size = args.size * MB
+    data = memoryview(os.urandom(size))
+    for name in ft.DIGESTS:
+        report(f"{name} in memory", size, hash_rate(name, data, args.rounds))
+    with tempfile.TemporaryDirectory() as src,\
+            tempfile.TemporaryDirectory() as dst:
+        path = os.path.join(src, "payload.bin")
+        make_file(path, size)
+        os.chdir(dst)
+        # the server picks the first digest both sides know, which is the
+        # first of ft.DIGESTS here
+        with server_process(src) as port:
+            for label, digest in (("raw", False), ("digest", True)):
+                costs = [asyncio.run(download(port, 1, digest))
+                         for _ in range(args.rounds)]
+                report(f"get {label}", size, costs)
+        with server_process(dst) as port:
+            for label, digest in (("raw", False), ("digest", True)):
+                costs = [asyncio.run(upload(port, path, digest))
+                         for _ in range(args.rounds)]
+                report(f"send {label}", size, costs)
+        os.chdir(HERE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="file-transfer benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("sendfile", help="sendfile vs chunked CMD_GET_FILE")
+    p.add_argument("-m", "--size", type=int, default=512, help="file size in MB")
+    p.add_argument("-r", "--rounds", type=int, default=3)
+    p.set_defaults(func=bench_sendfile)
+    p = sub.add_parser("pget", help="multi-stream download of one file")
+    p.add_argument("-m", "--size", type=int, default=512, help="file size in MB")
+    p.add_argument("-r", "--rounds", type=int, default=3)
+    p.add_argument("-n", "--streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.set_defaults(func=bench_pget)
+    p = sub.add_parser("tree", help="many small files, one by one vs -r")
+    p.add_argument("-n", "--files", type=int, default=20000)
+    p.add_argument("-k", "--size", type=int, default=4, help="file size in KB")
+    p.set_defaults(func=bench_tree)
+    p = sub.add_parser("writeback", help="server receive path, tmpfs and disk")
+    p.add_argument("-m", "--size", type=int, default=1024, help="file size in MB")
+    p.add_argument("-r", "--rounds", type=int, default=3)
+    p.add_argument("--tmpfs", default="/dev/shm")
+    p.add_argument("--disk", default=HERE)
+    p.set_defaults(func=bench_writeback)
+    p = sub.add_parser("load", help="many concurrent clients per worker count")
+    p.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("-c", "--connections", type=int, default=256)
+    p.add_argument("-p", "--procs", type=int, default=4,
+                   help="client processes generating the load")
+    p.add_argument("-t", "--seconds", type=int, default=10)
+    p.add_argument("-k", "--size", type=int, default=1024, help="file size in KB")
+    p.add_argument("-z", "--compress", action="store_true",
+                   help="negotiate compression so the server burns CPU")
+    p.set_defaults(func=bench_load)
+    p = sub.add_parser("hash", help="digest cost against raw get / send")
+    p.add_argument("-m", "--size", type=int, default=512, help="file size in MB")
+    p.add_argument("-r", "--rounds", type=int, default=3)
+    p.set_defaults(func=bench_hash)
+    p = sub.add_parser("fairness",
+                       help="small GET latency while big GETs are running")
+    p.add_argument("-b", "--big", type=int, default=4,
+                   help="concurrent big downloads")
+    p.add_argument("-m", "--size", type=int, default=256,
+                   help="big file size in MB")
+    p.add_argument("-k", "--small", type=int, default=16,
+                   help="small file size in KB")
+    p.add_argument("-t", "--seconds", type=int, default=5)
+    p.add_argument("--rate", type=float, default=200,
+                   help="also run with this server egress cap in MB/s, 0 skips")
+    p.set_defaults(func=bench_fairness)
+    args = parser.parse_args()
+    args.func(args)
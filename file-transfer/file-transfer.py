@@ -1,49 +1,176 @@
 import argparse
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import fnmatch
+import glob
+import hashlib
+import json
+import mmap
 import ntpath
 import os
+import signal
+import socket
+import sqlite3
+import stat
 import struct
 import sys
+import threading
+import time
+import traceback
+import weakref
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from tqdm import tqdm
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 '''
+Every message is a frame, a fixed header followed by LENGTH bytes of payload:
+-------------------------------------------------------------
+| CMD(1) | FLAGS(1) | LENGTH(8) | INDEX(4) | PAYLOAD(LENGTH) |
+-------------------------------------------------------------
+all integers are big endian and unsigned. File contents always travel in a
+DATA frame whose LENGTH is the byte count, so sizes are 64-bit everywhere.
+
+HELLO (must be the first frame, INDEX carries the protocol version, the
+client offers compression codecs and digests by preference, the server
+answers with the ones it picked or nothing):
+--> HELLO(INDEX=VERSION, CODEC "," ... "," DIGEST "," ...)
+<-- HELLO(INDEX=VERSION, [CODEC] ["," DIGEST]) | ERROR
+
 GET:
--------------------
-| CMD(1) | IDX(1) |
---------------------
---------------------------------------------------------------------
-| FILENAME_LEN(4) | FILENAME_DATA(N) | FILE_SIZE(4) | FILE_DATA(N) |
---------------------------------------------------------------------
+--> GET(INDEX=IDX)
+<-- GET(INDEX=IDX, FILENAME) DATA(FILE_DATA) [DIGEST] | ERROR
 
 LIST:
-----------
-| CMD(1) |
-----------
+--> LIST
+<-- LIST(INDEX=COUNT, NAME "/" NAME ...)
+
+LIST_PAGE (records are streamed in batches, a page starts after the name
+AFTER in sorted order, so entries added or removed between pages do not shift
+it. the END frame carries the AFTER of the next page, INDEX=0 once the
+listing is exhausted):
+--> LIST_PAGE(LIMIT(4) PATTERN_LEN(2) PATTERN AFTER)
+<-- LIST_PAGE(INDEX=N, RECORD * N) ... LIST_PAGE(FLAGS=END, INDEX=MORE, AFTER)
+RECORD:
+---------------------------------------------------------------------------
+| IDX(4) | SIZE(8) | MTIME(8) | IS_DIR(1) | NAME_LEN(2) | NAME_DATA(N) |
+---------------------------------------------------------------------------
+
+SEND (only acknowledged when a digest was negotiated):
+--> SEND(FILENAME) DATA(FILE_DATA) [DIGEST]
+<-- [SEND | ERROR]
+
+GET_RANGE (LENGTH 0 means up to the end of file):
+--> GET_RANGE(OFFSET(8) LENGTH(8) FILENAME)
+<-- GET_RANGE(FILE_SIZE(8) OFFSET(8)) DATA(FILE_DATA) | ERROR
+
+SEND_RESUME:
+--> SEND_RESUME(FILE_SIZE(8) FILENAME)
+<-- SEND_RESUME(OFFSET(8))
+--> DATA(FILE_DATA[OFFSET:])
+
+STAT:
+--> STAT(FILENAME)
+<-- STAT(FILE_SIZE(8)) | ERROR
+
+SEND_TREE (files are pipelined, only the whole tree is acknowledged):
+--> SEND_TREE TREE_FILE(RELPATH) DATA(FILE_DATA) ... SEND_TREE(FLAGS=END)
+<-- SEND_TREE(INDEX=COUNT)
+
+GET_TREE (PATTERN is a recursive glob, matching directories are walked):
+--> GET_TREE(PATTERN)
+<-- TREE_FILE(RELPATH) DATA(FILE_DATA) ... GET_TREE(FLAGS=END, INDEX=COUNT)
+
+When a codec was negotiated GET and SEND file contents are a DATA frame with
+FLAGS=CHUNKED whose LENGTH is the raw size, followed by CHUNK frames until
+that many raw bytes arrived. A CHUNK carries its raw size in INDEX and is
+compressed if FLAGS=COMPRESSED:
+DATA(FLAGS=CHUNKED) CHUNK(INDEX=RAW_LEN, FLAGS=COMPRESSED?, DATA) ...
+
+When a digest was negotiated GET and SEND file contents are a DATA frame with
+FLAGS=DIGEST, its body is followed by a DIGEST frame over the raw bytes. The
+receiver writes to a temp file that only replaces the target once the digest
+matched, a mismatch drops it and fails with BAD_DIGEST. A broken transfer
+leaves the temp file, SEND_RESUME and GET_RANGE go on from it:
+DATA(FLAGS=DIGEST, FILE_DATA | CHUNK ...) DIGEST(VALUE)
+
+SYNC (rsync style upload, the receiver publishes block signatures of its copy
+and only literal bytes plus references to its blocks come back):
+--> SYNC(FILE_SIZE(8) FILENAME)
+<-- SYNC(INDEX=BLOCK_SIZE, SIGNATURE * N)
+--> DELTA_LITERAL(DATA) | DELTA_COPY(INDEX=BLOCK, COUNT(4)) ... SYNC(FLAGS=END)
+<-- SYNC(LITERAL_BYTES(8) COPIED_BYTES(8))
+SIGNATURE:
 ----------------------------
-| STR_LEN(4) | STR_DATA(N) |
+| ADLER32(4) | BLAKE2B(16) |
 ----------------------------
 
-SEND:
------------------------------------------------------------------------------
-| CMD(1) | FILE_SIZE(4) | FILENAME_LEN(4) | FILENAME_DATA(N) | FILE_DATA(N) |
------------------------------------------------------------------------------
---------
-| NONE |
---------
+STATS (server side metrics as JSON):
+--> STATS
+<-- STATS(JSON)
+
+CLOSE:
+--> CLOSE
+
+ERROR (INDEX carries the Status code):
+<-- ERROR(INDEX=STATUS, MESSAGE)
 '''
 
 PORT = 11199
 SERVER_DFT_IP = "0.0.0.0"
 CLIENT_DFT_IP = "localhost"
 
+PROTOCOL_VERSION = 2
+
+# exit code of a server worker that could not bind its port or set up
+WORKER_START_FAILED = 2
+
 
 class CommandCode(Enum):
+    CMD_HELLO = 0
     CMD_GET_FILE = 1
     CMD_LIST_FILE = 2
     CMD_SEND_FILE = 3
     CMD_SEND_CLOSE = 4
+    CMD_GET_RANGE = 5
+    CMD_SEND_RESUME = 6
+    CMD_STAT_FILE = 7
+    CMD_ERROR = 8
+    CMD_DATA = 9
+    CMD_LIST_PAGE = 10
+    CMD_SEND_TREE = 11
+    CMD_GET_TREE = 12
+    CMD_TREE_FILE = 13
+    CMD_CHUNK = 14
+    CMD_SYNC_SEND = 15
+    CMD_DELTA_LITERAL = 16
+    CMD_DELTA_COPY = 17
+    CMD_STATS = 18
+    CMD_DIGEST = 19
 
 
 class Command(Enum):
@@ -51,11 +178,363 @@ class Command(Enum):
     CMD_LIST_FILE = "list"
     CMD_SEND_FILE = "send"
     CMD_SEND_CLOSE = "close"
+    CMD_GET_RANGE = "rget"
+    CMD_SEND_RESUME = "rsend"
+    CMD_PARALLEL_GET = "pget"
+    CMD_LIST_PAGE = "ls"
+    CMD_SYNC_SEND = "sync"
+    CMD_STATS = "stats"
+
+
+class Status(Enum):
+    OK = 0
+    NOT_FOUND = 1
+    BAD_REQUEST = 2
+    BAD_VERSION = 3
+    BAD_DIGEST = 4
+
+
+class TransferError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Session:
+    '''
+    server side state of one connection, lives exactly as long as its
+    handle_read_data
+    '''
+    __slots__ = ("peer", "files", "codec", "digest", "command",
+                 "connected_at", "bytes_in", "bytes_out", "samples",
+                 "write_behind", "writer", "bucket", "chunk", "throughput",
+                 "last_turn", "rtt")
+
+    def __init__(self, writer):
+        self.peer = "{}:{}".format(*writer.get_extra_info("peername")[:2])
+        self.writer = writer
+        self.files = []
+        self.codec = None
+        self.digest = None
+        self.command = None
+        self.connected_at = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # (timestamp, bytes, seconds) of the latest chunks
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.write_behind = None
+        # egress shaping, see Scheduler
+        self.bucket = None
+        self.chunk = MIN_CHUNK
+        self.throughput = 0.0
+        self.last_turn = None
+        self.rtt = None
+
+    def record(self, sent=0, received=0, latency=0.0):
+        self.bytes_out += sent
+        self.bytes_in += received
+        self.samples.append((time.time(), sent + received, latency))
+
+    def adapt(self, size):
+        '''
+        size the next send turn from the throughput seen between turns and
+        the RTT of the socket, growing at most twice per turn
+        '''
+        now = time.perf_counter()
+        if self.last_turn is not None:
+            last, last_size = self.last_turn
+            rate = last_size / max(now - last, 1e-6)
+            self.throughput = rate if not self.throughput\
+                else 0.75 * self.throughput + 0.25 * rate
+        self.last_turn = (now, size)
+        self.rtt = tcp_rtt(self.writer)
+        target = self.throughput * max(CHUNK_TIME, self.rtt or 0)
+        self.chunk = int(min(CHUNK_SIZE, 2 * self.chunk,
+                             max(MIN_CHUNK, target)))
+
+    def rate(self, now):
+        recent = sum(n for t, n, _ in self.samples if t > now - RATE_WINDOW)
+        return recent / min(RATE_WINDOW, max(now - self.connected_at, 1e-3))
+
+    def snapshot(self, now):
+        latencies = [latency for _, _, latency in self.samples]
+        transport = self.writer.transport
+        return {
+            "peer": self.peer,
+            "command": self.command.name if self.command else None,
+            "age": now - self.connected_at,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "rate": self.rate(now),
+            "send_buffer": transport.get_write_buffer_size(),
+            "write_queue": len(self.write_behind.pending)
+            if self.write_behind else 0,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "chunk": self.chunk,
+            "rtt_ms": (self.rtt or 0) * 1000,
+        }
+
+
+def tcp_rtt(writer):
+    '''
+    smoothed RTT in seconds from TCP_INFO, None where it is not available
+    '''
+    sock = writer.get_extra_info("socket")
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (OSError, AttributeError):
+        return None
+    if len(info) < 72:
+        return None
+    # tcpi_rtt of the linux struct tcp_info, in microseconds
+    return struct.unpack_from("I", info, 68)[0] / 1e6
+
+
+class TokenBucket:
+    '''
+    rate bytes per second with a burst of one second. reserve() always takes
+    the tokens, going into debt, and says how long to wait to pay it off
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def reserve(self, size):
+        now = time.monotonic()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Scheduler:
+    '''
+    send turns of the server's transfers. a connection first pays its own
+    bucket, then queues for the global one, which is handed out round robin
+    one chunk per waiting connection so a big transfer cannot starve small
+    ones. every turn resizes the connection's chunk
+    '''
+
+    def __init__(self):
+        self.bucket = None
+        # session -> deque of (future, size), in round robin order
+        self.queues = {}
+        self.task = None
+
+    async def turn(self, session, size):
+        if CONN_RATE_LIMIT:
+            if session.bucket is None:
+                session.bucket = TokenBucket(CONN_RATE_LIMIT)
+            delay = session.bucket.reserve(size)
+            if delay:
+                await asyncio.sleep(delay)
+        if RATE_LIMIT:
+            if self.bucket is None:
+                self.bucket = TokenBucket(RATE_LIMIT)
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self.queues.setdefault(session, deque()).append((future, size))
+            if self.task is None or self.task.done():
+                self.task = loop.create_task(self.dispatch())
+            await future
+        session.adapt(size)
+
+    async def dispatch(self):
+        while self.queues:
+            # connections queueing during a round wait for the next one
+            for session in list(self.queues):
+                queue = self.queues[session]
+                future, size = queue.popleft()
+                if not queue:
+                    del self.queues[session]
+                if future.done():
+                    continue
+                delay = self.bucket.reserve(size)
+                if delay:
+                    await asyncio.sleep(delay)
+                if not future.done():
+                    future.set_result(None)
+
+
+class BufferPool:
+    '''
+    CHUNK_SIZE buffers of the process, made on first use and handed from one
+    transfer to the next. at most WRITE_POOL_SIZE of them ever exist
+    '''
+
+    def __init__(self):
+        self.free = []
+        self.made = 0
+
+    def take(self, count):
+        # up to count buffers, fewer (or none) while the others are in use
+        bufs = []
+        while len(bufs) < count:
+            if self.free:
+                bufs.append(self.free.pop())
+            elif self.made < WRITE_POOL_SIZE:
+                self.made += 1
+                bufs.append(bytearray(CHUNK_SIZE))
+            else:
+                break
+        return bufs
+
+    def give(self, bufs):
+        self.free.extend(bufs)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def meter(sent=0, received=0, latency=0.0):
+    '''
+    count a chunk against the session served by this task, if any
+    '''
+    session = g_session.get()
+    if session is not None:
+        session.record(sent, received, latency)
 
 
+FRAME = struct.Struct(">BBQI")
+Frame = namedtuple("Frame", ["cmd", "flags", "length", "index"])
+
+FLAG_END = 0x01
+FLAG_CHUNKED = 0x02
+FLAG_COMPRESSED = 0x04
+FLAG_DIGEST = 0x08
+
+RECORD = struct.Struct(">IQdBH")
+FileRecord = namedtuple("FileRecord", ["index", "name", "size", "mtime",
+                                       "is_dir"])
+DirScan = namedtuple("DirScan", ["mtime_ns", "path", "names"])
+ConnInfo = namedtuple("ConnInfo", ["codec", "digest"])
+NO_CONN_INFO = ConnInfo(None, None)
+
+SIGNATURE = struct.Struct(">I16s")
+
+# control frames are read into memory, DATA frames are streamed
+MAX_CONTROL_LENGTH = 256 * 1024 * 1024
+
 CHUNK_SIZE = 4 * 1024 * 1024
+PARALLEL_STREAMS = 4
+LIST_PAGE_SIZE = 10000
+LIST_BATCH_SIZE = 500
+# small files of a tree are read / written this many at a time in the executor
+TREE_BATCH_FILES = 256
+
+# serve CMD_GET_FILE with loop.sendfile (os.sendfile) when the transport allows
+USE_SENDFILE = True
+# one sendfile call of the client pushes at most this much, so metrics stay
+# current, the server sends Session.chunk per turn
+SENDFILE_SLICE = 16 * CHUNK_SIZE
+
+# egress caps of the server in bytes per second, 0 is unlimited. the global
+# one applies per worker process
+RATE_LIMIT = 0
+CONN_RATE_LIMIT = 0
+# a send turn moves what the connection manages in CHUNK_TIME, or one RTT
+# worth if that is longer, within [MIN_CHUNK, CHUNK_SIZE]
+MIN_CHUNK = 64 * 1024
+CHUNK_TIME = 0.005
+
+# received data is written behind the socket from up to WRITE_QUEUE_DEPTH
+# CHUNK_SIZE buffers per file, on a pool of its own, 0 goes back to
+# read-then-write. the buffers come from WRITE_POOL_SIZE shared by the
+# process, files under one chunk and files arriving once all of them are in
+# use are read-then-write too
+WRITE_QUEUE_DEPTH = 4
+WRITE_POOL_SIZE = 16
+WRITER_THREADS = 4
+# fdatasync every this many received bytes of a file, 0 leaves it to the OS
+FSYNC_BYTES = 0
+DISK_EXECUTOR = ThreadPoolExecutor(max_workers=WRITER_THREADS,
+                                   thread_name_prefix="disk-writer")
+
+# zstandard (de)compressors are not thread safe and the executor runs the
+# chunks of every connection, so each thread makes its own
+g_zstd = threading.local()
+
+
+def zstd_compress(data):
+    if not hasattr(g_zstd, "compressor"):
+        g_zstd.compressor = zstandard.ZstdCompressor()
+    return g_zstd.compressor.compress(data)
+
+
+def zstd_decompress(data):
+    if not hasattr(g_zstd, "decompressor"):
+        g_zstd.decompressor = zstandard.ZstdDecompressor()
+    return g_zstd.decompressor.decompress(data)
+
 
-g_list_info = {}
+# name -> (compress, decompress), in order of preference
+CODECS = {}
+if zstandard is not None:
+    CODECS["zstd"] = (zstd_compress, zstd_decompress)
+if lz4 is not None:
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+CODECS["zlib"] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+
+# give up compressing a file when its first chunk does not shrink below this
+COMPRESS_MIN_RATIO = 0.9
+# not even worth sampling
+COMPRESSED_EXTS = {".gz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z",
+                   ".rar", ".jpg", ".jpeg", ".png", ".gif", ".mp3", ".mp4",
+                   ".mkv", ".bin"}
+
+# name -> hash constructor, in order of preference
+DIGESTS = {}
+if xxhash is not None and hasattr(xxhash, "xxh3_128"):
+    DIGESTS["xxh3"] = xxhash.xxh3_128
+DIGESTS["blake2b"] = lambda: hashlib.blake2b(digest_size=16)
+# hash updates a transfer may have queued before it waits for the hasher
+HASH_QUEUE_DEPTH = 4
+# every transfer hashes on this pool, its updates chained so they keep order
+HASH_THREADS = 4
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=HASH_THREADS,
+                                   thread_name_prefix="hasher")
+
+# block signatures of synced files and digests of served files, keyed by
+# path + mtime + size
+SIGNATURE_DB = os.path.join(os.path.expanduser("~"), ".cache",
+                            "file-transfer", "signatures.db")
+SYNC_MIN_BLOCK = 2 * 1024
+SYNC_MAX_BLOCK = 1024 * 1024
+# the rolling search moves about a MB/s where nothing matches. once this much
+# was scanned and over SYNC_MAX_LITERAL of it had to go literal, the rest of
+# the file is sent whole without looking for matches
+SYNC_PROBE_BYTES = 1024 * 1024
+SYNC_MAX_LITERAL = 0.5
+ADLER_MOD = 65521
+# GETs of files this big take their digest from SIGNATURE_DB once it is
+# known, so sendfile does not have to read them again to hash them
+DIGEST_CACHE_MIN = CHUNK_SIZE
+
+# chunk samples kept per connection for rates and latency percentiles
+LATENCY_SAMPLES = 1024
+RATE_WINDOW = 5
+
+# client side, reader -> ConnInfo of what HELLO negotiated
+g_conn_info = weakref.WeakKeyDictionary()
+# server side, sessions of the open connections
+g_sessions = set()
+# the Session of the connection the current task serves
+g_session = contextvars.ContextVar("session", default=None)
+g_scheduler = Scheduler()
+g_buffer_pool = BufferPool()
+# directory path -> DirScan of its names, reused until the directory mtime
+# changes. sizes and mtimes are looked up for every page
+g_dir_cache = {}
 
 
 def write_data(f, data):
@@ -66,95 +545,1273 @@ def read_data(f, size):
     return f.read(size)
 
 
-async def get_file(reader, writer):
+def write_frame_header(writer, cmd, length, flags=0, index=0):
+    writer.write(FRAME.pack(cmd.value, flags, length, index))
+
+
+def pack_frame(cmd, payload=b"", flags=0, index=0):
+    return FRAME.pack(cmd.value, flags, len(payload), index) + payload
+
+
+def write_frame(writer, cmd, payload=b"", flags=0, index=0):
+    write_frame_header(writer, cmd, len(payload), flags, index)
+    if payload:
+        writer.write(payload)
+
+
+def write_error(writer, status, message):
+    write_frame(writer, CommandCode.CMD_ERROR, message.encode(),
+                index=status.value)
+
+
+async def read_frame_header(reader, expect=None):
+    data = await reader.readexactly(FRAME.size)
+    cmd, flags, length, index = FRAME.unpack(data)
+    frame = Frame(CommandCode(cmd), flags, length, index)
+    if frame.cmd == CommandCode.CMD_ERROR:
+        message = await reader.readexactly(min(length, MAX_CONTROL_LENGTH))
+        raise TransferError(Status(index), message.decode())
+    if expect is not None and frame.cmd != expect:
+        raise TransferError(Status.BAD_REQUEST,
+                            f"expect {expect.name} but get {frame.cmd.name}")
+    return frame
+
+
+async def read_payload(reader, frame):
+    if frame.length > MAX_CONTROL_LENGTH:
+        raise TransferError(Status.BAD_REQUEST, "frame too large")
+    return await reader.readexactly(frame.length)
+
+
+async def read_frame(reader, expect=None):
+    frame = await read_frame_header(reader, expect)
+    return frame, await read_payload(reader, frame)
+
+
+async def send_turn(size):
+    '''
+    wait until the connection served by this task may send size bytes
+    '''
+    session = g_session.get()
+    if session is not None:
+        await g_scheduler.turn(session, size)
+
+
+def send_size(remaining, default=CHUNK_SIZE):
+    session = g_session.get()
+    return min(session.chunk if session is not None else default, remaining)
+
+
+def hash_all(h, pieces):
+    for data in pieces:
+        h.update(data)
+
+
+def hash_file(h, path, offset, count):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while count > 0:
+            data = f.read(min(CHUNK_SIZE, count))
+            if(not data):
+                break
+            h.update(data)
+            count -= len(data)
+
+
+async def chained(prev, fn, args):
+    if prev is not None:
+        await prev
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(HASH_EXECUTOR, fn, *args)
+
+
+class StreamHasher:
+    '''
+    running digest of one transfer. each update goes to HASH_EXECUTOR once
+    the one before it finished, so they keep their order, and the socket loop
+    only waits for the hash once it is more than HASH_QUEUE_DEPTH updates
+    behind
+    '''
+
+    def __init__(self, name):
+        self.h = DIGESTS[name]()
+        self.pending = deque()
+
+    async def submit(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        prev = self.pending[-1] if self.pending else None
+        self.pending.append(loop.create_task(chained(prev, fn, args)))
+        if len(self.pending) > HASH_QUEUE_DEPTH:
+            await self.pending.popleft()
+
+    async def update(self, *pieces):
+        await self.submit(hash_all, self.h, pieces)
+
+    async def update_file(self, f, offset, count):
+        # sendfile data never passes through us, hash it from the page cache
+        await self.submit(hash_file, self.h, f.name, offset, count)
+
+    async def digest(self):
+        while self.pending:
+            await self.pending.popleft()
+        return self.h.digest()
+
+    def close(self):
+        # a transfer that failed leaves updates nobody waits for
+        for task in self.pending:
+            task.cancel()
+        self.pending.clear()
+
+
+async def write_file_data(writer, f, offset, count, hasher=None):
+    '''
+    push count bytes of f starting at offset to the peer. zero-copy through
+    loop.sendfile if possible, otherwise read chunks in the executor so the
+    event loop never blocks on disk
+    '''
+    loop = asyncio.get_event_loop()
+    n = 0
+    if USE_SENDFILE:
+        try:
+            await writer.drain()
+            while n < count:
+                size = send_size(count - n, SENDFILE_SLICE)
+                await send_turn(size)
+                start = time.perf_counter()
+                sent = await loop.sendfile(writer.transport, f, offset + n,
+                                           size, fallback=False)
+                if(not sent):
+                    break
+                meter(sent=sent, latency=time.perf_counter() - start)
+                if hasher is not None:
+                    await hasher.update_file(f, offset + n, sent)
+                n += sent
+            return
+        except (asyncio.SendfileNotAvailableError, NotImplementedError,
+                AttributeError):
+            pass
+    f.seek(offset + n)
+    while n < count:
+        size = send_size(count - n)
+        await send_turn(size)
+        data = await loop.run_in_executor(None, read_data, f, size)
+        if(not data):
+            break
+        n += len(data)
+        start = time.perf_counter()
+        writer.write(data)
+        await writer.drain()
+        meter(sent=len(data), latency=time.perf_counter() - start)
+        if hasher is not None:
+            await hasher.update(data)
+
+
+def read_chunk(f, size, compress):
+    raw = f.read(size)
+    if compress is None or not raw:
+        return raw, raw, False
+    data = compress(raw)
+    if len(data) >= len(raw):
+        return raw, raw, False
+    return raw, data, True
+
+
+def update_bar(bar, raw, wire, start):
+    bar.update(raw)
+    if wire:
+        cost = max(time.perf_counter() - start, 1e-6)
+        bar.set_postfix(ratio=f"{bar.n / wire:.2f}",
+                        wire=f"{wire / cost / 1024 / 1024:.1f}MB/s",
+                        refresh=False)
+
+
+async def write_chunks(writer, f, offset, count, codec, bar=None,
+                       hasher=None):
+    '''
+    send count bytes of f as CHUNK frames, compressed with codec in the
+    executor one chunk ahead of the socket. compression stops for the rest of
+    the file once the first chunk shows it does not pay off
+    '''
+    loop = asyncio.get_event_loop()
+    compress = CODECS[codec][0]
+    if os.path.splitext(getattr(f, "name", ""))[1].lower() in COMPRESSED_EXTS:
+        compress = None
+    f.seek(offset)
+    start = time.perf_counter()
+    n = 0
+    wire = 0
+    pending = loop.run_in_executor(None, read_chunk, f, send_size(count),
+                                   compress)
+    while n < count:
+        raw, data, compressed = await pending
+        raw_len = len(raw)
+        if(not raw_len):
+            raise TransferError(Status.BAD_REQUEST, "file shrank while sending")
+        if n == 0 and len(data) > raw_len * COMPRESS_MIN_RATIO:
+            compress = None
+        n += raw_len
+        if n < count:
+            pending = loop.run_in_executor(None, read_chunk, f,
+                                           send_size(count - n), compress)
+        await send_turn(FRAME.size + len(data))
+        chunk_start = time.perf_counter()
+        write_frame(writer, CommandCode.CMD_CHUNK, data,
+                    flags=FLAG_COMPRESSED if compressed else 0, index=raw_len)
+        wire += FRAME.size + len(data)
+        await writer.drain()
+        meter(sent=FRAME.size + len(data),
+              latency=time.perf_counter() - chunk_start)
+        if hasher is not None:
+            await hasher.update(raw)
+        if bar is not None:
+            update_bar(bar, raw_len, wire, start)
+
+
+async def write_data_frame(writer, f, offset, count, codec=None, bar=None,
+                           digest=None, known=None):
+    '''
+    send count bytes of f as a DATA frame, followed by their digest if one is
+    set. known is that digest if it is already known, nothing is hashed then.
+    returns the digest sent
+    '''
+    hasher = StreamHasher(digest) if digest and known is None else None
+    flags = FLAG_DIGEST if digest else 0
+    try:
+        if codec is None:
+            write_frame_header(writer, CommandCode.CMD_DATA, count, flags)
+            await write_file_data(writer, f, offset, count, hasher)
+            if bar is not None:
+                bar.update(count)
+        else:
+            write_frame_header(writer, CommandCode.CMD_DATA, count,
+                               FLAG_CHUNKED | flags)
+            await write_chunks(writer, f, offset, count, codec, bar, hasher)
+        if hasher is not None:
+            known = await hasher.digest()
+        if digest:
+            write_frame(writer, CommandCode.CMD_DIGEST, known)
+    finally:
+        if hasher is not None:
+            hasher.close()
+    return known
+
+
+def pwrite_all(fd, buf, size, offset):
+    view = memoryview(buf)[:size]
+    n = 0
+    while n < size:
+        n += os.pwrite(fd, view[n:], offset + n)
+
+
+def sync_fd(fd):
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class WriteBehind:
+    '''
+    bounded write-behind queue of a file. the caller fills a free buffer,
+    submits it and goes back to the socket while DISK_EXECUTOR writes it with
+    os.pwrite. once every buffer is in flight buffer() waits, which stops
+    reading and lets TCP push back on the sender. the buffers go back to
+    g_buffer_pool on close, or once written if that is later
+    '''
+
+    def __init__(self, f, bufs):
+        self.f = f
+        self.fd = f.fileno()
+        self.offset = f.tell()
+        self.free = asyncio.Queue()
+        for buf in bufs:
+            self.free.put_nowait(buf)
+        self.pending = set()
+        self.unsynced = 0
+        self.error = None
+        self.closed = False
+
+    async def buffer(self):
+        buf = await self.free.get()
+        if self.error is not None:
+            raise self.error
+        return buf
+
+    def submit(self, buf, size):
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(DISK_EXECUTOR, pwrite_all, self.fd, buf,
+                                      size, self.offset)
+        self.offset += size
+        self.unsynced += size
+        self.pending.add(future)
+
+        def done(future):
+            self.pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self.error = future.exception()
+            if self.closed:
+                g_buffer_pool.give([buf])
+            else:
+                self.free.put_nowait(buf)
+
+        future.add_done_callback(done)
+
+    async def flush(self, sync=False):
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+        if self.error is not None:
+            raise self.error
+        if sync and self.unsynced:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(DISK_EXECUTOR, sync_fd, self.fd)
+            self.unsynced = 0
+
+    async def maybe_sync(self):
+        if FSYNC_BYTES and self.unsynced >= FSYNC_BYTES:
+            await self.flush(True)
+
+    async def close(self):
+        try:
+            await self.flush(bool(FSYNC_BYTES))
+            self.f.seek(self.offset)
+        finally:
+            self.closed = True
+            while not self.free.empty():
+                g_buffer_pool.give([self.free.get_nowait()])
+
+
+async def read_to_file(reader, f, size, bar=None, hasher=None):
+    if WRITE_QUEUE_DEPTH and size >= CHUNK_SIZE and hasattr(os, "pwrite"):
+        bufs = g_buffer_pool.take(WRITE_QUEUE_DEPTH)
+        if bufs:
+            await read_to_file_behind(reader, f, size, bufs, bar, hasher)
+            return
+    loop = asyncio.get_event_loop()
+    n = 0
+    while n < size:
+        start = time.perf_counter()
+        data = await reader.read(min(CHUNK_SIZE, size - n))
+        if(not data):
+            raise ConnectionError("connection closed during transfer")
+        n += len(data)
+        meter(received=len(data), latency=time.perf_counter() - start)
+        if hasher is not None:
+            await hasher.update(data)
+        await loop.run_in_executor(None, write_data, f, data)
+        if bar is not None:
+            bar.update(len(data))
+
+
+async def read_to_file_behind(reader, f, size, bufs, bar=None, hasher=None):
+    wb = WriteBehind(f, bufs)
+    session = g_session.get()
+    if session is not None:
+        session.write_behind = wb
+    try:
+        n = 0
+        while n < size:
+            buf = await wb.buffer()
+            want = min(len(buf), size - n)
+            filled = 0
+            # buf goes back to the pool once written, the hasher gets the
+            # pieces it was filled from instead
+            pieces = []
+            start = time.perf_counter()
+            while filled < want:
+                data = await reader.read(want - filled)
+                if(not data):
+                    raise ConnectionError("connection closed during transfer")
+                buf[filled:filled + len(data)] = data
+                filled += len(data)
+                if hasher is not None:
+                    pieces.append(data)
+                if bar is not None:
+                    bar.update(len(data))
+            n += filled
+            meter(received=filled, latency=time.perf_counter() - start)
+            if hasher is not None:
+                await hasher.update(*pieces)
+            wb.submit(buf, filled)
+            await wb.maybe_sync()
+    finally:
+        if session is not None:
+            session.write_behind = None
+        await wb.close()
+
+
+def write_chunk(f, data, decompress):
+    if decompress is not None:
+        data = decompress(data)
+    f.write(data)
+    return data
+
+
+async def read_chunks(reader, f, size, codec, bar=None, hasher=None):
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    n = 0
+    wire = 0
+    while n < size:
+        chunk_start = time.perf_counter()
+        frame, data = await read_frame(reader, CommandCode.CMD_CHUNK)
+        meter(received=FRAME.size + len(data),
+              latency=time.perf_counter() - chunk_start)
+        decompress = None
+        if frame.flags & FLAG_COMPRESSED:
+            if codec is None:
+                raise TransferError(Status.BAD_REQUEST, "no codec negotiated")
+            decompress = CODECS[codec][1]
+        raw = await loop.run_in_executor(None, write_chunk, f, data,
+                                         decompress)
+        raw_len = len(raw)
+        if raw_len != frame.index:
+            raise TransferError(Status.BAD_REQUEST, "corrupted chunk")
+        if hasher is not None:
+            await hasher.update(raw)
+        n += raw_len
+        wire += FRAME.size + len(data)
+        if bar is not None:
+            update_bar(bar, raw_len, wire, start)
+
+
+async def read_data_body(reader, frame, f, codec=None, bar=None,
+                         digest=None):
+    hasher = None
+    if frame.flags & FLAG_DIGEST:
+        if digest is None:
+            raise TransferError(Status.BAD_REQUEST, "no digest negotiated")
+        hasher = StreamHasher(digest)
+    try:
+        if frame.flags & FLAG_CHUNKED:
+            await read_chunks(reader, f, frame.length, codec, bar, hasher)
+        else:
+            await read_to_file(reader, f, frame.length, bar, hasher)
+        if hasher is None:
+            return
+        _, expect = await read_frame(reader, CommandCode.CMD_DIGEST)
+        if await hasher.digest() != expect:
+            raise TransferError(Status.BAD_DIGEST, "digest mismatch")
+    finally:
+        if hasher is not None:
+            hasher.close()
+
+
+async def read_data_frame(reader, f, codec=None, bar=None):
+    frame = await read_frame_header(reader, CommandCode.CMD_DATA)
+    await read_data_body(reader, frame, f, codec, bar)
+    return frame.length
+
+
+def part_name(filename, suffix=".part"):
+    return os.path.join(os.path.dirname(filename),
+                        "." + os.path.basename(filename) + suffix)
+
+
+async def receive_file(reader, frame, filename, codec=None, bar=None,
+                       digest=None):
+    '''
+    receive the body of a DATA frame into a temp file next to filename and
+    only rename it over filename once all of it arrived and checked out. a
+    digest mismatch drops the temp file, anything else keeps what arrived to
+    be resumed
+    '''
+    tmpname = part_name(filename)
+    try:
+        with open(tmpname, "wb") as f:
+            await read_data_body(reader, frame, f, codec, bar, digest)
+        os.replace(tmpname, filename)
+    except TransferError as e:
+        if e.status == Status.BAD_DIGEST and os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def resume_point(filename, limit=None):
+    '''
+    (path, offset) to go on writing filename at, the temp file of a broken
+    GET or SEND if there is one, else filename itself. a copy longer than
+    limit is not a prefix of the incoming file and starts over
+    '''
+    for path in (part_name(filename), filename):
+        if os.path.isfile(path):
+            offset = os.path.getsize(path)
+            if limit is not None and offset > limit:
+                offset = 0
+            return path, offset
+    return filename, 0
+
+
+def open_at(filename, offset):
+    '''
+    open filename for writing at offset without truncating what is already
+    there
+    '''
+    f = open(filename, "r+b" if os.path.exists(filename) else "wb")
+    f.seek(offset)
+    return f
+
+
+def safe_name(data):
+    return ntpath.basename(data.decode())
+
+
+def safe_relpath(path):
+    '''
+    turn a "/" separated relative path from the peer into a local one, refusing
+    anything that would escape the working directory
+    '''
+    parts = [p for p in path.replace("\\", "/").split("/")
+             if p not in ("", ".")]
+    if not parts or ".." in parts or ntpath.splitdrive(path)[0]\
+            or path.startswith(("/", "\\")):
+        raise TransferError(Status.BAD_REQUEST, f"Bad path {path}")
+    return os.path.join(*parts)
+
+
+def walk_tree(root, paths):
+    '''
+    expand paths (files or directories) into (relpath, size) relative to root
+    '''
+    entries = []
+
+    def add(path):
+        relpath = os.path.relpath(path, root).replace(os.sep, "/")
+        entries.append((relpath, os.path.getsize(path)))
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    add(os.path.join(dirpath, fn))
+        elif os.path.isfile(path):
+            add(path)
+    return entries
+
+
+def match_tree(pattern):
+    return walk_tree(".", sorted(glob.glob(pattern, recursive=True)))
+
+
+def read_files(root, entries):
+    result = []
+    for relpath, _ in entries:
+        with open(os.path.join(root, relpath), "rb") as f:
+            result.append((relpath, f.read()))
+    return result
+
+
+def make_parent(path):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+
+def write_files(files):
+    for path, data in files:
+        make_parent(path)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+async def write_tree(writer, root, entries, bar=None):
+    '''
+    pipeline TREE_FILE + DATA frames for every entry without waiting for the
+    peer. small files are read in batches and leave in a single write, big
+    ones go through write_data_frame
+    '''
+    loop = asyncio.get_event_loop()
+    batch = []
+    batch_size = 0
+
+    async def flush():
+        if not batch:
+            return
+        files = await loop.run_in_executor(None, read_files, root, batch)
+        buf = bytearray()
+        for relpath, data in files:
+            buf += pack_frame(CommandCode.CMD_TREE_FILE, relpath.encode())
+            buf += pack_frame(CommandCode.CMD_DATA, data)
+        await send_turn(len(buf))
+        start = time.perf_counter()
+        writer.write(buf)
+        await writer.drain()
+        meter(sent=len(buf), latency=time.perf_counter() - start)
+        if bar is not None:
+            bar.update(sum(len(data) for _, data in files))
+        batch.clear()
+
+    for relpath, size in entries:
+        if size >= CHUNK_SIZE:
+            await flush()
+            batch_size = 0
+            write_frame(writer, CommandCode.CMD_TREE_FILE, relpath.encode())
+            with open(os.path.join(root, relpath), "rb") as f:
+                await write_data_frame(writer, f, 0, size)
+            if bar is not None:
+                bar.update(size)
+            continue
+        batch.append((relpath, size))
+        batch_size += size
+        if batch_size >= CHUNK_SIZE or len(batch) >= TREE_BATCH_FILES:
+            await flush()
+            batch_size = 0
+    await flush()
+
+
+async def read_tree(reader, end_cmd, bar=None):
+    '''
+    receive TREE_FILE + DATA frames until an end_cmd END frame, returns the
+    number of files written
+    '''
+    loop = asyncio.get_event_loop()
+    pending = []
+    pending_size = 0
+    count = 0
+    while(1):
+        frame = await read_frame_header(reader)
+        if frame.cmd == end_cmd and frame.flags & FLAG_END:
+            break
+        if frame.cmd != CommandCode.CMD_TREE_FILE:
+            raise TransferError(Status.BAD_REQUEST,
+                                f"unexpected {frame.cmd.name} in tree")
+        path = safe_relpath((await read_payload(reader, frame)).decode())
+        frame = await read_frame_header(reader, CommandCode.CMD_DATA)
+        count += 1
+        if frame.length < CHUNK_SIZE:
+            pending.append((path, await reader.readexactly(frame.length)))
+            pending_size += frame.length
+            meter(received=frame.length)
+            if bar is not None:
+                bar.update(frame.length)
+            if pending_size < CHUNK_SIZE and len(pending) < TREE_BATCH_FILES:
+                continue
+        if pending:
+            await loop.run_in_executor(None, write_files, pending)
+            pending = []
+            pending_size = 0
+        if frame.length >= CHUNK_SIZE:
+            await loop.run_in_executor(None, make_parent, path)
+            with open(path, "wb") as f:
+                await read_to_file(reader, f, frame.length, bar)
+    if pending:
+        await loop.run_in_executor(None, write_files, pending)
+    return count
+
+
+async def hello(reader, writer):
+    # a version 1 client starts with a bare one byte command and would wait
+    # forever for us to read a full header, so look at the first byte alone
     data = await reader.readexactly(1)
-    index = struct.unpack(">b", data)[0]
-    filename = g_list_info[id(reader)][index - 1]
-    filesize = os.path.getsize(filename)
-    filename_b = filename.encode()
-    data = struct.pack(">i", len(filename_b))
-    writer.write(data)
-    writer.write(filename_b)
-    data = struct.pack(">i", filesize)
-    writer.write(data)
+    if data[0] != CommandCode.CMD_HELLO.value:
+        raise TransferError(Status.BAD_VERSION, "legacy client")
+    data += await reader.readexactly(FRAME.size - 1)
+    frame = Frame(*FRAME.unpack(data))
+    offered = (await read_payload(reader, frame)).decode().split(",")
+    version = min(frame.index, PROTOCOL_VERSION)
+    if version < PROTOCOL_VERSION:
+        write_error(writer, Status.BAD_VERSION,
+                    f"protocol version {frame.index} is not supported")
+        await writer.drain()
+        raise TransferError(Status.BAD_VERSION, "client version too old")
+    session = g_session.get()
+    session.codec = next((c for c in offered if c in CODECS), None)
+    session.digest = next((d for d in offered if d in DIGESTS), None)
+    picked = [name for name in (session.codec, session.digest) if name]
+    write_frame(writer, CommandCode.CMD_HELLO, ",".join(picked).encode(),
+                index=version)
+    await writer.drain()
+
+
+def scan_dir(path):
+    with os.scandir(path) as it:
+        return sorted(entry.name for entry in it)
+
+
+def stat_records(path, batch):
+    '''
+    FileRecord of every (index, name) in batch as the entry is now, names
+    removed since the scan are left out
+    '''
+    records = []
+    for index, name in batch:
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        records.append(FileRecord(index, name, st.st_size, st.st_mtime,
+                                  stat.S_ISDIR(st.st_mode)))
+    return records
+
+
+async def cached_scan(path="."):
+    '''
+    names in path scanned in the executor, or the previous scan as long as
+    the directory mtime shows no entry was added, removed or renamed. writing
+    to a file does not change that mtime, so the scan keeps no metadata
+    '''
+    path = os.path.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    scan = g_dir_cache.get(path)
+    if scan is None or scan.mtime_ns != mtime_ns:
+        loop = asyncio.get_event_loop()
+        names = await loop.run_in_executor(None, scan_dir, path)
+        scan = DirScan(mtime_ns, path, names)
+        g_dir_cache[path] = scan
+    return scan
+
+
+async def get_file(reader, writer, frame):
+    files = g_session.get().files
+    if not 0 < frame.index <= len(files):
+        write_error(writer, Status.NOT_FOUND, "Index out of range")
+        await writer.drain()
+        return
+    filename = files[frame.index - 1]
+    session = g_session.get()
+    loop = asyncio.get_event_loop()
+    try:
+        f = open(filename, "rb")
+    except (FileNotFoundError, IsADirectoryError):
+        # a directory of the listing, or a file gone since
+        write_error(writer, Status.NOT_FOUND, f"{filename} is not a file")
+        await writer.drain()
+        return
+    except OSError as e:
+        write_error(writer, Status.BAD_REQUEST, f"{filename}: {e.strerror}")
+        await writer.drain()
+        return
+    with f:
+        st = os.fstat(f.fileno())
+        write_frame(writer, CommandCode.CMD_GET_FILE, filename.encode(),
+                    index=frame.index)
+        cache = session.digest and st.st_size >= DIGEST_CACHE_MIN
+        known = None
+        if cache:
+            known = await loop.run_in_executor(None, load_digest, filename,
+                                               st, session.digest)
+        value = await write_data_frame(writer, f, 0, st.st_size,
+                                       session.codec, digest=session.digest,
+                                       known=known)
+        # a file changed while it was sent may not match what was hashed
+        now = os.fstat(f.fileno())
+        if(cache and known is None and
+           (now.st_mtime_ns, now.st_size) == (st.st_mtime_ns, st.st_size)):
+            await loop.run_in_executor(None, store_digest, filename, st,
+                                       session.digest, value)
+
+
+async def list_file(reader, writer, frame):
+    files = (await cached_scan()).names
+    g_session.get().files = files
+    data = "/".join(files)
+    data = data.encode()
+    write_frame(writer, CommandCode.CMD_LIST_FILE, data, index=len(files))
     await writer.drain()
+
+
+def pack_records(records):
+    data = bytearray()
+    for r in records:
+        name_b = r.name.encode()
+        data += RECORD.pack(r.index, r.size, r.mtime, r.is_dir, len(name_b))
+        data += name_b
+    return bytes(data)
+
+
+async def list_page(reader, writer, frame):
+    loop = asyncio.get_event_loop()
+    payload = await read_payload(reader, frame)
+    limit, pattern_len = struct.unpack_from(">IH", payload)
+    limit = limit or LIST_PAGE_SIZE
+    pattern = payload[6:6 + pattern_len].decode() or "*"
+    after = payload[6 + pattern_len:].decode()
+    scan = await cached_scan()
+    # indexes of the page are the same ones CMD_GET_FILE takes
+    g_session.get().files = scan.names
+    cursor = bisect.bisect_right(scan.names, after) if after else 0
+    batch = []
+    sent = 0
+
+    async def flush():
+        records = await loop.run_in_executor(None, stat_records, scan.path,
+                                             batch)
+        write_frame(writer, CommandCode.CMD_LIST_PAGE, pack_records(records),
+                    index=len(records))
+        await writer.drain()
+        batch.clear()
+
+    while cursor < len(scan.names) and sent < limit:
+        name = scan.names[cursor]
+        cursor += 1
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        batch.append((cursor, name))
+        sent += 1
+        if len(batch) == LIST_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    more = cursor < len(scan.names)
+    after = scan.names[cursor - 1] if more else ""
+    write_frame(writer, CommandCode.CMD_LIST_PAGE, after.encode(),
+                flags=FLAG_END, index=int(more))
+    await writer.drain()
+
+
+async def send_file(reader, writer, frame):
+    session = g_session.get()
+    filename = safe_name(await read_payload(reader, frame))
+    frame = await read_frame_header(reader, CommandCode.CMD_DATA)
+    try:
+        await receive_file(reader, frame, filename, session.codec,
+                           digest=session.digest)
+    except TransferError as e:
+        if e.status != Status.BAD_DIGEST:
+            raise
+        # the stream is still in step, tell the client and carry on
+        write_error(writer, e.status, f"{filename}: {e}")
+        await writer.drain()
+        return
+    if frame.flags & FLAG_DIGEST:
+        write_frame(writer, CommandCode.CMD_SEND_FILE)
+        await writer.drain()
+
+
+async def get_range(reader, writer, frame):
+    payload = await read_payload(reader, frame)
+    offset, length = struct.unpack_from(">QQ", payload)
+    filename = safe_name(payload[16:])
+    if not os.path.isfile(filename):
+        write_error(writer, Status.NOT_FOUND, "File is not exists")
+        await writer.drain()
+        return
+    filesize = os.path.getsize(filename)
+    offset = min(offset, filesize)
+    if length == 0 or offset + length > filesize:
+        length = filesize - offset
+    write_frame(writer, CommandCode.CMD_GET_RANGE,
+                struct.pack(">QQ", filesize, offset))
     with open(filename, "rb") as f:
+        await write_data_frame(writer, f, offset, length)
+
+
+async def send_resume(reader, writer, frame):
+    payload = await read_payload(reader, frame)
+    filesize = struct.unpack_from(">Q", payload)[0]
+    filename = safe_name(payload[8:])
+    path, offset = resume_point(filename, filesize)
+    write_frame(writer, CommandCode.CMD_SEND_RESUME, struct.pack(">Q", offset))
+    await writer.drain()
+    with open_at(path, offset) as f:
+        f.truncate()
+        await read_data_frame(reader, f)
+    if path != filename:
+        os.replace(path, filename)
+
+
+async def stat_file(reader, writer, frame):
+    filename = safe_name(await read_payload(reader, frame))
+    if os.path.isfile(filename):
+        write_frame(writer, CommandCode.CMD_STAT_FILE,
+                    struct.pack(">Q", os.path.getsize(filename)))
+    else:
+        write_error(writer, Status.NOT_FOUND, "File is not exists")
+    await writer.drain()
+
+
+async def send_tree(reader, writer, frame):
+    await read_payload(reader, frame)
+    count = await read_tree(reader, CommandCode.CMD_SEND_TREE)
+    write_frame(writer, CommandCode.CMD_SEND_TREE, index=count)
+    await writer.drain()
+
+
+async def get_tree(reader, writer, frame):
+    pattern = (await read_payload(reader, frame)).decode()
+    try:
+        safe_relpath(pattern)
+    except TransferError as e:
+        write_error(writer, e.status, str(e))
+        await writer.drain()
+        return
+    loop = asyncio.get_event_loop()
+    entries = await loop.run_in_executor(None, match_tree, pattern)
+    await write_tree(writer, ".", entries)
+    write_frame(writer, CommandCode.CMD_GET_TREE, flags=FLAG_END,
+                index=len(entries))
+    await writer.drain()
+
+
+def sync_block_size(size):
+    # about sqrt(size) like rsync, rounded to a power of two
+    block = SYNC_MIN_BLOCK
+    while block < SYNC_MAX_BLOCK and block * block < size:
+        block *= 2
+    return block
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class SignatureBuilder:
+    '''
+    signature of every full block of a stream fed in arbitrary pieces
+    '''
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.pending = bytearray()
+        self.blocks = bytearray()
+
+    def update(self, data):
+        self.pending += data
+        bs = self.block_size
+        n = len(self.pending) - len(self.pending) % bs
+        for i in range(0, n, bs):
+            block = bytes(self.pending[i:i + bs])
+            self.blocks += SIGNATURE.pack(zlib.adler32(block),
+                                          strong_hash(block))
+        del self.pending[:n]
+
+    def digest(self):
+        return bytes(self.blocks)
+
+
+def open_signature_db():
+    os.makedirs(os.path.dirname(SIGNATURE_DB), exist_ok=True)
+    db = sqlite3.connect(SIGNATURE_DB)
+    db.execute("CREATE TABLE IF NOT EXISTS signature (path TEXT PRIMARY KEY,"
+               " mtime_ns INTEGER, size INTEGER, block_size INTEGER,"
+               " blocks BLOB)")
+    db.execute("CREATE TABLE IF NOT EXISTS digest (path TEXT, name TEXT,"
+               " mtime_ns INTEGER, size INTEGER, value BLOB,"
+               " PRIMARY KEY (path, name))")
+    return db
+
+
+def store_signature(path, block_size, blocks):
+    st = os.stat(path)
+    db = open_signature_db()
+    try:
+        with db:
+            db.execute("REPLACE INTO signature VALUES (?, ?, ?, ?, ?)",
+                       (os.path.abspath(path), st.st_mtime_ns, st.st_size,
+                        block_size, blocks))
+    finally:
+        db.close()
+
+
+def load_signature(path):
+    '''
+    (block_size, blocks) of path, taken from the index while the file keeps
+    its mtime and size, rehashed otherwise
+    '''
+    if not os.path.isfile(path):
+        return SYNC_MIN_BLOCK, b""
+    st = os.stat(path)
+    db = open_signature_db()
+    try:
+        row = db.execute("SELECT block_size, blocks FROM signature WHERE"
+                         " path = ? AND mtime_ns = ? AND size = ?",
+                         (os.path.abspath(path), st.st_mtime_ns,
+                          st.st_size)).fetchone()
+    finally:
+        db.close()
+    if row:
+        return row[0], row[1]
+    builder = SignatureBuilder(sync_block_size(st.st_size))
+    with open(path, "rb") as f:
         while(1):
             data = f.read(CHUNK_SIZE)
             if(not data):
                 break
-            writer.write(data)
-            await writer.drain()
+            builder.update(data)
+    store_signature(path, builder.block_size, builder.digest())
+    return builder.block_size, builder.digest()
 
 
-async def list_file(reader, writer):
-    files = os.listdir()
-    g_list_info[id(reader)] = files
-    data = "/".join(files)
-    data = data.encode()
-    size = struct.pack(">i", len(data))
-    writer.write(size)
-    writer.write(data)
-    await writer.drain()
+def load_digest(path, st, name):
+    '''
+    digest name of path from the index while the file keeps the mtime and
+    size of st, None otherwise
+    '''
+    try:
+        db = open_signature_db()
+        try:
+            row = db.execute("SELECT value FROM digest WHERE path = ? AND"
+                             " name = ? AND mtime_ns = ? AND size = ?",
+                             (os.path.abspath(path), name, st.st_mtime_ns,
+                              st.st_size)).fetchone()
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error):
+        # the index is a cache, the file gets hashed as it is sent
+        return None
+    return row and row[0]
+
+
+def store_digest(path, st, name, value):
+    try:
+        db = open_signature_db()
+        try:
+            with db:
+                db.execute("REPLACE INTO digest VALUES (?, ?, ?, ?, ?)",
+                           (os.path.abspath(path), name, st.st_mtime_ns,
+                            st.st_size, value))
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error):
+        pass
+
 
+def parse_signature(blocks):
+    '''
+    weak hash -> {strong hash: block number}
+    '''
+    table = {}
+    for i, (weak, strong) in enumerate(SIGNATURE.iter_unpack(blocks)):
+        table.setdefault(weak, {}).setdefault(strong, i)
+    return table
 
-async def send_file(reader, writer):
+
+def generate_delta(path, block_size, table):
+    '''
+    yield ("copy", block, count) and ("literal", data) that rebuild path from
+    the blocks in table. the weak hash is an adler32 rolled one byte at a time
+    only where nothing matches, aligned runs are checked block by block. a
+    file that mostly does not match goes literal from where that shows
+    '''
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # nothing to match against, skip the rolling
+            pos = 0 if table else size
+            literal_start = 0
+            literal = 0
+            check_at = SYNC_PROBE_BYTES
+            weak = None
+            copy = None
+            while pos + block_size <= size:
+                if pos >= check_at:
+                    check_at = pos + 64 * 1024
+                    if literal + pos - literal_start > pos * SYNC_MAX_LITERAL:
+                        break
+                if weak is None:
+                    weak = zlib.adler32(m[pos:pos + block_size])
+                candidates = table.get(weak)
+                if candidates:
+                    block = candidates.get(strong_hash(m[pos:pos + block_size]))
+                    if block is not None:
+                        if literal_start < pos:
+                            if copy:
+                                yield copy
+                                copy = None
+                            yield ("literal", m[literal_start:pos])
+                            literal += pos - literal_start
+                        if copy and copy[1] + copy[2] == block:
+                            copy = ("copy", copy[1], copy[2] + 1)
+                        else:
+                            if copy:
+                                yield copy
+                            copy = ("copy", block, 1)
+                        pos += block_size
+                        literal_start = pos
+                        weak = None
+                        continue
+                if pos + block_size < size:
+                    out, new = m[pos], m[pos + block_size]
+                    a = ((weak & 0xffff) - out + new) % ADLER_MOD
+                    b = ((weak >> 16) - block_size * out + a - 1) % ADLER_MOD
+                    weak = (b << 16) | a
+                pos += 1
+                if pos - literal_start >= CHUNK_SIZE:
+                    if copy:
+                        yield copy
+                        copy = None
+                    yield ("literal", m[literal_start:pos])
+                    literal += pos - literal_start
+                    literal_start = pos
+            if copy:
+                yield copy
+            for i in range(literal_start, size, CHUNK_SIZE):
+                yield ("literal", m[i:min(i + CHUNK_SIZE, size)])
+        finally:
+            m.close()
+
+
+def next_delta_ops(ops, limit=CHUNK_SIZE):
+    batch = []
+    size = 0
+    for op in ops:
+        batch.append(op)
+        if op[0] == "literal":
+            size += len(op[1])
+        if size >= limit or len(batch) >= 1024:
+            break
+    return batch
+
+
+def apply_literal(out, builder, data):
+    out.write(data)
+    builder.update(data)
+
+
+def apply_copy(basis, out, builder, block_size, block, count):
+    basis.seek(block * block_size)
+    remain = count * block_size
+    while remain > 0:
+        data = basis.read(min(CHUNK_SIZE, remain))
+        if(not data):
+            raise TransferError(Status.BAD_REQUEST, "block out of range")
+        remain -= len(data)
+        apply_literal(out, builder, data)
+
+
+async def sync_send(reader, writer, frame):
     loop = asyncio.get_event_loop()
-    data = await reader.readexactly(4)
-    filesize = struct.unpack(">i", data)[0]
-    data = await reader.readexactly(4)
-    size = struct.unpack(">i", data)[0]
-    data = await reader.read(size)
-    filepath = data.decode()
-    filename = ntpath.basename(filepath)
-    n = 0
-    with open(filename, "wb") as f:
-        while n < filesize:
-            data = await reader.read(CHUNK_SIZE)
-            read_size = len(data)
-            n += read_size
-            await loop.run_in_executor(None, write_data, f, data)
+    payload = await read_payload(reader, frame)
+    filesize = struct.unpack_from(">Q", payload)[0]
+    filename = safe_name(payload[8:])
+    block_size, blocks = await loop.run_in_executor(None, load_signature,
+                                                    filename)
+    write_frame(writer, CommandCode.CMD_SYNC_SEND, blocks, index=block_size)
+    await writer.drain()
+    # the new copy is hashed on the way to disk so the next sync of it does
+    # not have to
+    builder = SignatureBuilder(sync_block_size(filesize))
+    tmpname = part_name(filename, ".sync")
+    literal = copied = 0
+    basis = open(filename, "rb") if os.path.isfile(filename) else None
+    try:
+        with open(tmpname, "wb") as out:
+            while(1):
+                frame = await read_frame_header(reader)
+                if(frame.cmd == CommandCode.CMD_SYNC_SEND and
+                   frame.flags & FLAG_END):
+                    break
+                data = await read_payload(reader, frame)
+                meter(received=FRAME.size + len(data))
+                if frame.cmd == CommandCode.CMD_DELTA_LITERAL:
+                    await loop.run_in_executor(None, apply_literal, out,
+                                               builder, data)
+                    literal += len(data)
+                elif frame.cmd == CommandCode.CMD_DELTA_COPY and basis:
+                    count = struct.unpack(">I", data)[0]
+                    await loop.run_in_executor(None, apply_copy, basis, out,
+                                               builder, block_size,
+                                               frame.index, count)
+                    copied += count * block_size
+                else:
+                    raise TransferError(Status.BAD_REQUEST,
+                                        f"unexpected {frame.cmd.name} in sync")
+        if basis:
+            basis.close()
+            basis = None
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    finally:
+        if basis:
+            basis.close()
+    await loop.run_in_executor(None, store_signature, filename,
+                               builder.block_size, builder.digest())
+    write_frame(writer, CommandCode.CMD_SYNC_SEND,
+                struct.pack(">QQ", literal, copied))
+    await writer.drain()
+
+
+async def stats(reader, writer, frame):
+    await read_payload(reader, frame)
+    now = time.time()
+    sessions = [session.snapshot(now) for session in g_sessions]
+    latencies = [latency for session in g_sessions
+                 for _, _, latency in session.samples]
+    data = {
+        "active": len(sessions),
+        "rate": sum(s["rate"] for s in sessions),
+        "write_queue": sum(s["write_queue"] for s in sessions),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "sessions": sorted(sessions, key=lambda s: s["rate"]),
+    }
+    write_frame(writer, CommandCode.CMD_STATS, json.dumps(data).encode())
+    await writer.drain()
+
+
+HANDLERS = {
+    CommandCode.CMD_GET_FILE: get_file,
+    CommandCode.CMD_LIST_FILE: list_file,
+    CommandCode.CMD_SEND_FILE: send_file,
+    CommandCode.CMD_GET_RANGE: get_range,
+    CommandCode.CMD_SEND_RESUME: send_resume,
+    CommandCode.CMD_STAT_FILE: stat_file,
+    CommandCode.CMD_LIST_PAGE: list_page,
+    CommandCode.CMD_SEND_TREE: send_tree,
+    CommandCode.CMD_GET_TREE: get_tree,
+    CommandCode.CMD_SYNC_SEND: sync_send,
+    CommandCode.CMD_STATS: stats,
+}
 
 
 async def handle_read_data(reader, writer):
     print("Client connected")
-    while(1):
-        try:
-            cmd = await reader.read(1)
-            cmd = CommandCode(struct.unpack(">b", cmd)[0])
-            print("Get cmd : ", cmd)
-            if(cmd == CommandCode.CMD_GET_FILE):
-                await get_file(reader, writer)
-            elif(cmd == CommandCode.CMD_LIST_FILE):
-                await list_file(reader, writer)
-            elif(cmd == CommandCode.CMD_SEND_FILE):
-                await send_file(reader, writer)
-            elif(cmd == CommandCode.CMD_SEND_CLOSE):
-                reader.close()
-                writer.close()
+    session = Session(writer)
+    g_session.set(session)
+    g_sessions.add(session)
+    try:
+        await hello(reader, writer)
+        while(1):
+            session.command = None
+            frame = await read_frame_header(reader)
+            session.command = frame.cmd
+            print("Get cmd : ", frame.cmd)
+            if(frame.cmd == CommandCode.CMD_SEND_CLOSE):
                 break
-            else:
-                writer.write(b'Unrecognized comomand')
+            handler = HANDLERS.get(frame.cmd)
+            if handler is None:
+                await read_payload(reader, frame)
+                write_error(writer, Status.BAD_REQUEST,
+                            "Unrecognized comomand")
                 await writer.drain()
-        except Exception as e:
-            print("Close this connection")
-            print(str(e))
-            break
+                continue
+            await handler(reader, writer, frame)
+    except Exception as e:
+        print("Close this connection")
+        print(str(e))
+    finally:
+        g_sessions.discard(session)
+    writer.close()
     print("Client disconnected")
-    if(id(reader) in g_list_info):
-        del g_list_info[id(reader)]
 
 
-async def create_server(address, port, loop):
-    server = await asyncio.start_server(handle_read_data, address, port, loop=loop)
+async def create_server(address, port, loop, reuse_port=False):
+    server = await asyncio.start_server(handle_read_data, address, port,
+                                        reuse_port=reuse_port)
     return server
 
 
-def run_server(port=PORT):
-    loop = asyncio.get_event_loop()
-    server = loop.run_until_complete(create_server(SERVER_DFT_IP, port, loop))
+def start_serving(port, reuse_port=False):
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        create_server(SERVER_DFT_IP, port, loop, reuse_port))
     host = server.sockets[0].getsockname()
-    print('Serving on {}. Hit CTRL-C to stop.'.format(host))
+    print('Serving on {} (pid {}). Hit CTRL-C to stop.'.format(
+        host, os.getpid()))
+    return loop, server
+
+
+def serve(port, reuse_port=False, started=None):
+    loop, server = started or start_serving(port, reuse_port)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -165,30 +1822,132 @@ def run_server(port=PORT):
     loop.close()
 
 
-async def get_request(reader, writer, index):
-    cmd = CommandCode.CMD_GET_FILE
-    data = struct.pack(">b", cmd.value)
-    writer.write(data)
-    data = struct.pack(">b", int(index))
-    writer.write(data)
+def run_server(port=PORT, workers=1):
+    '''
+    serve in this process, or fork workers that all bind port with
+    SO_REUSEPORT and let the kernel spread connections among them. sessions,
+    stats and the listing cache are per worker
+    '''
+    if workers <= 1:
+        serve(port)
+        return
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        print("--workers needs fork and SO_REUSEPORT")
+        sys.exit(1)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                try:
+                    started = start_serving(port, reuse_port=True)
+                except BaseException:
+                    code = WORKER_START_FAILED
+                    raise
+                serve(port, started=started)
+            except BaseException:
+                traceback.print_exc()
+                code = code or 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children.append(pid)
+
+    stopping = [False]
+
+    def stop(signum, frame):
+        stopping[0] = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    remaining = set(children)
+    failed = 0
+    while remaining:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            # the workers got the same SIGINT, wait for them to finish
+            continue
+        except ChildProcessError:
+            break
+        remaining.discard(pid)
+        code = exit_code(status)
+        # killed by the SIGTERM of stop() is how a worker should end
+        if code == 0 or (stopping[0] and code == -signal.SIGTERM):
+            continue
+        failed += 1
+        if code == WORKER_START_FAILED:
+            print(f"worker {pid} failed to start")
+            # a port the others could not bind either, or a broken setup
+            stop(None, None)
+        else:
+            print(f"worker {pid} exited with {code}")
+    if failed:
+        sys.exit(1)
+
+
+def exit_code(status):
+    # exit code of a waitpid status, minus the signal for a killed process
+    if hasattr(os, "waitstatus_to_exitcode"):
+        return os.waitstatus_to_exitcode(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def connect(address, port, compress=False, digest=True):
+    '''
+    open a connection and negotiate the protocol version, plus a compression
+    codec for GET and SEND if compress is set and a digest to verify them
+    with if digest is set
+    '''
+    reader, writer = await asyncio.open_connection(address, port)
+    offer = (list(CODECS) if compress else []) + (list(DIGESTS) if digest
+                                                  else [])
+    write_frame(writer, CommandCode.CMD_HELLO, ",".join(offer).encode(),
+                index=PROTOCOL_VERSION)
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_HELLO)
+    info = NO_CONN_INFO
+    for name in filter(None, data.decode().split(",")):
+        if name in CODECS:
+            info = info._replace(codec=name)
+        elif name in DIGESTS:
+            info = info._replace(digest=name)
+        else:
+            writer.close()
+            raise TransferError(Status.BAD_REQUEST, f"Unknown codec {name}")
+    g_conn_info[reader] = info
+    return reader, writer
+
+
+async def start_get_request(reader, writer, index):
+    '''
+    ask for file index of the last listing, returns its name and the header
+    of the DATA frame that follows
+    '''
+    write_frame(writer, CommandCode.CMD_GET_FILE, index=int(index))
     await writer.drain()
-    data = await reader.readexactly(4)
-    size = struct.unpack(">i", data)[0]
-    data = await reader.readexactly(size)
-    filename = data.decode()
-    data = await reader.readexactly(4)
-    size = struct.unpack(">i", data)[0]
-    print("Filename size : ", size)
+    _, data = await read_frame(reader, CommandCode.CMD_GET_FILE)
+    frame = await read_frame_header(reader, CommandCode.CMD_DATA)
+    return safe_name(data), frame
+
+
+async def get_request(reader, writer, index):
+    filename, frame = await start_get_request(reader, writer, index)
+    size = frame.length
     print("Filename : ", filename)
     print("Filesize : ", size)
-    n = 0
-    with open(filename, "wb") as f, tqdm(total=size) as bar:
-        while(n < size):
-            read_data = await reader.read(CHUNK_SIZE)
-            read_size = len(read_data)
-            n += read_size
-            bar.update(read_size)
-            f.write(read_data)
+    info = g_conn_info.get(reader, NO_CONN_INFO)
+    with tqdm(total=size) as bar:
+        await receive_file(reader, frame, filename, info.codec, bar,
+                           info.digest)
 
 
 def print_file_list(arr):
@@ -197,20 +1956,101 @@ def print_file_list(arr):
 
 
 async def list_request(reader, writer):
-    cmd = CommandCode.CMD_LIST_FILE
-    data = struct.pack(">b", cmd.value)
-    writer.write(data)
+    write_frame(writer, CommandCode.CMD_LIST_FILE)
     await writer.drain()
-    data = await reader.readexactly(4)
-    size = struct.unpack(">i", data)[0]
-    n = 0
-    data = bytearray()
-    while(n < size):
-        read_data = await reader.read(size)
-        data.extend(read_data)
-        n += len(read_data)
+    _, data = await read_frame(reader, CommandCode.CMD_LIST_FILE)
     line = data.decode()
-    print_file_list(line.split("/"))
+    files = line.split("/")
+    print_file_list(files)
+    return files
+
+
+def unpack_records(data):
+    offset = 0
+    while offset < len(data):
+        index, size, mtime, is_dir, name_len = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        name = data[offset:offset + name_len].decode()
+        offset += name_len
+        yield FileRecord(index, name, size, mtime, bool(is_dir))
+
+
+async def list_page_request(reader, writer, pattern="*", after="",
+                            limit=LIST_PAGE_SIZE):
+    '''
+    yield FileRecord of the page after name after as the batches arrive, the
+    after of the next page (None at the end) is yielded last
+    '''
+    pattern_b = pattern.encode()
+    write_frame(writer, CommandCode.CMD_LIST_PAGE,
+                struct.pack(">IH", limit, len(pattern_b)) + pattern_b +
+                after.encode())
+    await writer.drain()
+    while(1):
+        frame, data = await read_frame(reader, CommandCode.CMD_LIST_PAGE)
+        if frame.flags & FLAG_END:
+            yield data.decode() if frame.index else None
+            return
+        for record in unpack_records(data):
+            yield record
+
+
+async def iter_list_request(reader, writer, pattern="*"):
+    after = ""
+    while(1):
+        async for item in list_page_request(reader, writer, pattern, after):
+            if isinstance(item, FileRecord):
+                yield item
+            else:
+                after = item
+        if after is None:
+            return
+
+
+def format_record(record):
+    mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.mtime))
+    name = record.name + ("/" if record.is_dir else "")
+    return f"{record.index} {record.size:>14} {mtime} {name}"
+
+
+async def find_request(reader, writer, name):
+    '''
+    index of file name for CMD_GET_FILE, listing nothing but that name
+    '''
+    index = None
+    async for item in list_page_request(reader, writer, glob.escape(name),
+                                        "", 1):
+        if isinstance(item, FileRecord) and item.name == name\
+                and not item.is_dir:
+            index = item.index
+    if index is None:
+        raise TransferError(Status.NOT_FOUND, f"{name} is not exists")
+    return index
+
+
+async def ls_request(reader, writer, pattern="*"):
+    files = {}
+    async for record in iter_list_request(reader, writer, pattern):
+        files[record.index] = record.name
+        print(format_record(record))
+    return files
+
+
+async def put_request(reader, writer, filepath, bar=None):
+    '''
+    upload filepath, with a digest this returns only once the server
+    confirmed the copy
+    '''
+    filesize = os.path.getsize(filepath)
+    write_frame(writer, CommandCode.CMD_SEND_FILE, filepath.encode())
+    info = g_conn_info.get(reader, NO_CONN_INFO)
+    with open(filepath, "rb") as f:
+        await write_data_frame(writer, f, 0, filesize, info.codec, bar,
+                               info.digest)
+    if info.digest is not None:
+        await writer.drain()
+        await read_frame(reader, CommandCode.CMD_SEND_FILE)
+    return filesize
 
 
 async def send_request(reader, writer, filepath):
@@ -218,35 +2058,394 @@ async def send_request(reader, writer, filepath):
     if not os.path.exists(filepath):
         print("File is not exists")
         return
+    print(f"Prepare to send file:{filepath.encode()}")
+    with tqdm(total=os.path.getsize(filepath)) as bar:
+        await put_request(reader, writer, filepath, bar)
+
+
+async def send_tree_request(reader, writer, dirpath):
+    '''
+    upload dirpath recursively, it lands as basename(dirpath) on the server
+    '''
+    if not os.path.isdir(dirpath):
+        print("Directory is not exists")
+        return
+    loop = asyncio.get_event_loop()
+    dirpath = os.path.abspath(dirpath)
+    root = os.path.dirname(dirpath)
+    entries = await loop.run_in_executor(None, walk_tree, root, [dirpath])
+    total = sum(size for _, size in entries)
+    print(f"Prepare to send {len(entries)} files, {total} bytes")
+    write_frame(writer, CommandCode.CMD_SEND_TREE)
+    with tqdm(total=total, unit="B", unit_scale=True) as bar:
+        await write_tree(writer, root, entries, bar)
+    write_frame(writer, CommandCode.CMD_SEND_TREE, flags=FLAG_END,
+                index=len(entries))
+    await writer.drain()
+    frame = await read_frame_header(reader, CommandCode.CMD_SEND_TREE)
+    print(f"{frame.index} files sent")
+
+
+async def get_tree_request(reader, writer, pattern):
+    write_frame(writer, CommandCode.CMD_GET_TREE, pattern.encode())
+    await writer.drain()
+    with tqdm(unit="B", unit_scale=True) as bar:
+        count = await read_tree(reader, CommandCode.CMD_GET_TREE, bar)
+    print(f"{count} files received")
+
+
+async def sync_request(reader, writer, filepath):
+    '''
+    upload filepath sending only what the server's copy does not have, or
+    the rest of it whole once most of it turns out not to match
+    '''
+    if not os.path.isfile(filepath):
+        print("File is not exists")
+        return
     loop = asyncio.get_event_loop()
-    cmd = CommandCode.CMD_SEND_FILE
-    data = struct.pack(">b", cmd.value)
-    writer.write(data)
     filesize = os.path.getsize(filepath)
-    data = struct.pack(">i",  filesize)
-    writer.write(data)
-    filepath_b = filepath.encode()
-    data = struct.pack(">i",  len(filepath_b))
-    writer.write(data)
-    writer.write(filepath_b)
+    write_frame(writer, CommandCode.CMD_SYNC_SEND,
+                struct.pack(">Q", filesize) + filepath.encode())
     await writer.drain()
-    print(f"Prepare to send file:{filepath_b}")
-    with open(filepath, "rb") as f, tqdm(total=filesize) as bar:
+    frame, blocks = await read_frame(reader, CommandCode.CMD_SYNC_SEND)
+    block_size = frame.index
+    table = await loop.run_in_executor(None, parse_signature, blocks)
+    ops = generate_delta(filepath, block_size, table)
+    with tqdm(total=filesize, unit="B", unit_scale=True) as bar:
         while(1):
-            data = await loop.run_in_executor(None, read_data, f, CHUNK_SIZE)
-            if(not data):
+            batch = await loop.run_in_executor(None, next_delta_ops, ops)
+            if not batch:
                 break
-            bar.update(len(data))
-            writer.write(data)
+            buf = bytearray()
+            for op in batch:
+                if op[0] == "literal":
+                    buf += pack_frame(CommandCode.CMD_DELTA_LITERAL, op[1])
+                    bar.update(len(op[1]))
+                else:
+                    buf += pack_frame(CommandCode.CMD_DELTA_COPY,
+                                      struct.pack(">I", op[2]), index=op[1])
+                    bar.update(op[2] * block_size)
+            writer.write(buf)
             await writer.drain()
+    write_frame(writer, CommandCode.CMD_SYNC_SEND, flags=FLAG_END)
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_SYNC_SEND)
+    literal, copied = struct.unpack(">QQ", data)
+    print(f"Synced {filepath}: {literal} literal bytes, {copied} bytes reused")
+
+
+async def stats_request(reader, writer):
+    write_frame(writer, CommandCode.CMD_STATS)
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_STATS)
+    return json.loads(data.decode())
+
+
+def print_stats(data):
+    print(f"active {data['active']}, {data['rate'] / 1024 / 1024:.1f} MB/s, "
+          f"write queue {data['write_queue']}, "
+          f"chunk p50 {data['p50_ms']:.1f}ms p99 {data['p99_ms']:.1f}ms")
+    for s in data["sessions"]:
+        print(f"{s['peer']:<22} {s['command'] or '-':<16} "
+              f"{s['rate'] / 1024 / 1024:8.1f} MB/s "
+              f"in {s['bytes_in']:>12} out {s['bytes_out']:>12} "
+              f"sndbuf {s['send_buffer']:>9} wq {s['write_queue']} "
+              f"chunk {s['chunk'] // 1024}K rtt {s['rtt_ms']:.2f}ms "
+              f"p50 {s['p50_ms']:.1f}ms p99 {s['p99_ms']:.1f}ms")
+
+
+async def range_request(reader, writer, filename, offset, length):
+    '''
+    ask for a range of filename, returns (filesize, offset, length) of what
+    the server is about to send in the following DATA frame
+    '''
+    write_frame(writer, CommandCode.CMD_GET_RANGE,
+                struct.pack(">QQ", offset, length) + filename.encode())
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_GET_RANGE)
+    filesize, offset = struct.unpack(">QQ", data)
+    frame = await read_frame_header(reader, CommandCode.CMD_DATA)
+    return filesize, offset, frame.length
+
+
+async def stat_request(reader, writer, filename):
+    write_frame(writer, CommandCode.CMD_STAT_FILE, filename.encode())
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_STAT_FILE)
+    return struct.unpack(">Q", data)[0]
+
+
+def close_request(writer):
+    write_frame(writer, CommandCode.CMD_SEND_CLOSE)
+    writer.close()
+
+
+def preallocate(fd, size):
+    os.ftruncate(fd, size)
+    if hasattr(os, "posix_fallocate") and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+
+async def parallel_get_request(address, port, filename,
+                               streams=PARALLEL_STREAMS):
+    '''
+    download one file over several connections, each fetching its own byte
+    range with CMD_GET_RANGE and writing it in place with os.pwrite
+    '''
+    loop = asyncio.get_event_loop()
+    reader, writer = await connect(address, port)
+    try:
+        filesize = await stat_request(reader, writer, filename)
+    finally:
+        close_request(writer)
+    streams = max(1, min(int(streams), filesize // CHUNK_SIZE or 1))
+    step = max(1, -(-filesize // streams))
+    ranges = [(offset, min(step, filesize - offset))
+              for offset in range(0, filesize, step)]
+    print("Filename : ", filename)
+    print(f"Filesize : {filesize}, streams : {len(ranges)}")
+
+    async def fetch_range(fd, offset, length, bar):
+        reader, writer = await connect(address, port)
+        try:
+            await range_request(reader, writer, filename, offset, length)
+            n = 0
+            while n < length:
+                data = await reader.read(min(CHUNK_SIZE, length - n))
+                if(not data):
+                    raise ConnectionError("connection closed during transfer")
+                await loop.run_in_executor(
+                    None, os.pwrite, fd, data, offset + n)
+                n += len(data)
+                bar.update(len(data))
+        finally:
+            close_request(writer)
+
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        preallocate(fd, filesize)
+        with tqdm(total=filesize, unit="B", unit_scale=True) as bar:
+            await asyncio.gather(*(fetch_range(fd, offset, length, bar)
+                                   for offset, length in ranges))
+    finally:
+        os.close(fd)
+
+
+async def get_range_request(reader, writer, filename, offset=None, length=0):
+    '''
+    fetch [offset, offset + length) of filename, offset defaults to the size
+    of the local copy, or of the temp file a broken get left, so an
+    interrupted download picks up where it stopped
+    '''
+    path = filename
+    if offset is None:
+        path, offset = resume_point(filename)
+    filesize, offset, length = await range_request(
+        reader, writer, filename, int(offset), int(length))
+    print("Filename : ", filename)
+    print(f"Range : {offset}-{offset + length} of {filesize}")
+    with open_at(path, offset) as f,\
+            tqdm(total=offset + length, initial=offset) as bar:
+        await read_to_file(reader, f, length, bar)
+    if path != filename and offset + length == filesize:
+        os.replace(path, filename)
+
+
+async def send_resume_request(reader, writer, filepath):
+    if not os.path.exists(filepath):
+        print("File is not exists")
+        return
+    filesize = os.path.getsize(filepath)
+    write_frame(writer, CommandCode.CMD_SEND_RESUME,
+                struct.pack(">Q", filesize) + filepath.encode())
+    await writer.drain()
+    _, data = await read_frame(reader, CommandCode.CMD_SEND_RESUME)
+    offset = struct.unpack(">Q", data)[0]
+    print(f"Resume sending {filepath} from {offset}")
+    with open(filepath, "rb") as f,\
+            tqdm(total=filesize, initial=offset) as bar:
+        write_frame_header(writer, CommandCode.CMD_DATA, filesize - offset)
+        await write_file_data(writer, f, offset, filesize - offset)
+        bar.update(filesize - offset)
+
+
+class FileTransferClient:
+    '''
+    scriptable client of one server. every call borrows one of up to
+    max_connections connections, which stay open between calls, so concurrent
+    calls run side by side and the following ones skip the handshake. limit
+    is an optional semaphore capping calls in flight across several clients
+
+        async with FileTransferClient(address, port) as client:
+            for record in await client.list("*.csv"):
+                await client.get(record.name, "data")
+            await client.send("report.txt")
+    '''
+
+    def __init__(self, address=CLIENT_DFT_IP, port=PORT, compress=False,
+                 digest=True, max_connections=PARALLEL_STREAMS, limit=None):
+        self.address = address
+        self.port = int(port)
+        self.compress = compress
+        self.digest = digest
+        self.max_connections = max_connections
+        self.limit = limit
+        # semaphores bind to the running loop, so make it on first use
+        self.slots = None
+        self.idle = []
+        self.closed = False
+
+    async def open(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return await connect(self.address, self.port, self.compress,
+                             self.digest)
+
+    def release(self, conn, reuse):
+        if reuse and not self.closed:
+            self.idle.append(conn)
+        elif reuse:
+            close_request(conn[1])
+        else:
+            conn[1].close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        '''
+        borrow a (reader, writer) pair. it goes back to the pool unless the
+        block failed in a way that may leave the stream out of step
+        '''
+        if self.closed:
+            raise TransferError(Status.BAD_REQUEST, "client is closed")
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        if self.limit is not None:
+            await self.limit.acquire()
+        try:
+            async with self.slots:
+                conn = await self.open()
+                reuse = False
+                try:
+                    yield conn
+                    reuse = True
+                except TransferError as e:
+                    # the peer's ERROR frame or the DIGEST trailer was read
+                    reuse = e.status in (Status.NOT_FOUND, Status.BAD_DIGEST)
+                    raise
+                finally:
+                    self.release(conn, reuse)
+        finally:
+            if self.limit is not None:
+                self.limit.release()
+
+    async def list(self, pattern="*"):
+        async with self.connection() as (reader, writer):
+            return [record async for record in
+                    iter_list_request(reader, writer, pattern)]
+
+    async def get(self, name, dest=None, bar=None):
+        '''
+        download file name to dest, a directory or a file path, which
+        defaults to name in the working directory. returns the path written
+        '''
+        async with self.connection() as (reader, writer):
+            index = await find_request(reader, writer, name)
+            filename, frame = await start_get_request(reader, writer, index)
+            if dest is None:
+                dest = filename
+            elif os.path.isdir(dest):
+                dest = os.path.join(dest, filename)
+            info = g_conn_info.get(reader, NO_CONN_INFO)
+            await receive_file(reader, frame, dest, info.codec, bar,
+                               info.digest)
+            return dest
+
+    async def send(self, path, bar=None):
+        '''
+        upload path under its base name, returns the bytes sent
+        '''
+        # fail on a missing file before the connection is touched
+        os.path.getsize(path)
+        async with self.connection() as (reader, writer):
+            return await put_request(reader, writer, path, bar)
+
+    async def close(self):
+        self.closed = True
+        writers = [writer for _, writer in self.idle]
+        self.idle = []
+        for writer in writers:
+            close_request(writer)
+        await asyncio.gather(*(writer.wait_closed() for writer in writers),
+                             return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class FileTransferPool:
+    '''
+    a FileTransferClient per server, made on first use, all sharing a cap of
+    limit calls in flight so one process can fan out to many servers
+    '''
+
+    def __init__(self, limit=1024, **options):
+        self.limit = limit
+        self.options = options
+        self.semaphore = None
+        self.clients = {}
+
+    def client(self, address, port=PORT):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        key = (address, int(port))
+        client = self.clients.get(key)
+        if client is None:
+            client = FileTransferClient(address, port, limit=self.semaphore,
+                                        **self.options)
+            self.clients[key] = client
+        return client
+
+    async def close(self):
+        clients = list(self.clients.values())
+        self.clients = {}
+        await asyncio.gather(*(client.close() for client in clients))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def create_connect(address, port, loop, compress=False, digest=True):
+    # the CLI keeps one connection for the session, GET indexes refer to the
+    # listing done on it
+    client = FileTransferClient(address, port, compress, digest,
+                                max_connections=1)
+    async with client, client.connection() as (reader, writer):
+        await prompt_loop(client, reader, writer, loop)
 
 
-async def create_connect(address, port, loop):
-    reader, writer = await asyncio.open_connection(address, port, loop=loop)
+async def prompt_loop(client, reader, writer, loop):
+    address, port = client.address, client.port
+    files = {}
     while(1):
         sys.stdout.write("Type command : ")
         sys.stdout.flush()
-        cmd = sys.stdin.readline()
+        # stdin is read in the executor, a blocking readline on the loop
+        # would stall every transfer in flight
+        cmd = await loop.run_in_executor(None, sys.stdin.readline)
+        if(cmd == ""):
+            return
         if(cmd.strip() == ""):
             continue
         try:
@@ -255,23 +2454,51 @@ async def create_connect(address, port, loop):
                 cmds[1] = " ".join(cmds[1:]).strip('"')
 
             cmd = Command(cmds[0])
-            if(cmd == Command.CMD_GET_FILE):
+            recursive = len(cmds) > 1 and cmds[1].startswith("-r ")
+            if(recursive):
+                cmds[1] = cmds[1][3:].strip().strip('"')
+            if(cmd == Command.CMD_GET_FILE and recursive):
+                await get_tree_request(reader, writer, cmds[1])
+            elif(cmd == Command.CMD_SEND_FILE and recursive):
+                await send_tree_request(reader, writer, cmds[1])
+            elif(cmd == Command.CMD_GET_FILE):
                 await get_request(reader, writer, cmds[1])
             elif(cmd == Command.CMD_LIST_FILE):
-                await list_request(reader, writer)
+                files = dict(enumerate(await list_request(reader, writer), 1))
             elif(cmd == Command.CMD_SEND_FILE):
                 await send_request(reader, writer, cmds[1])
+            elif(cmd == Command.CMD_GET_RANGE):
+                # rget <idx> [offset] [length]
+                args = cmds[1].split()
+                filename = files[int(args[0])]
+                await get_range_request(reader, writer, filename, *args[1:3])
+            elif(cmd == Command.CMD_SEND_RESUME):
+                await send_resume_request(reader, writer, cmds[1])
+            elif(cmd == Command.CMD_PARALLEL_GET):
+                # pget <idx> [streams]
+                args = cmds[1].split()
+                filename = files[int(args[0])]
+                await parallel_get_request(address, port, filename, *args[1:2])
+            elif(cmd == Command.CMD_LIST_PAGE):
+                # ls [pattern]
+                pattern = cmds[1] if len(cmds) > 1 else "*"
+                files = await ls_request(reader, writer, pattern)
+            elif(cmd == Command.CMD_SYNC_SEND):
+                await sync_request(reader, writer, cmds[1])
+            elif(cmd == Command.CMD_STATS):
+                print_stats(await stats_request(reader, writer))
             elif(cmd == Command.CMD_SEND_CLOSE):
-                exit()
-        except IndexError:
+                return
+        except (IndexError, KeyError):
             print("Should provide rightful command argument")
         except Exception as e:
             print(str(e))
 
 
-def run_client(address, port=PORT):
+def run_client(address, port=PORT, compress=False, digest=True):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(create_connect(address, port, loop))
+    loop.run_until_complete(create_connect(address, port, loop, compress,
+                                           digest))
     print('Client shutting down.')
     loop.close()
 
@@ -283,8 +2510,30 @@ if __name__ == '__main__':
                        const=PORT, help="listening server port")
     group.add_argument("-c", "--client", nargs='+',
                        help="server ip and port that will connect to")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="serve files with chunked reads instead of sendfile")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="server worker processes sharing the port")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        help="client asks for compressed get / send")
+    parser.add_argument("--no-digest", action="store_true",
+                        help="client does not verify get / send with a digest")
+    parser.add_argument("--write-depth", type=int, default=WRITE_QUEUE_DEPTH,
+                        help="receive buffers in flight to disk, 0 disables")
+    parser.add_argument("--fsync-every", type=int, default=0, metavar="MB",
+                        help="fdatasync received files every MB megabytes")
+    parser.add_argument("--rate", type=float, default=0, metavar="MB",
+                        help="server egress cap in MB/s per worker")
+    parser.add_argument("--conn-rate", type=float, default=0, metavar="MB",
+                        help="server egress cap in MB/s per connection")
     args = parser.parse_args()
+    USE_SENDFILE = not args.no_sendfile
+    WRITE_QUEUE_DEPTH = args.write_depth
+    FSYNC_BYTES = args.fsync_every * 1024 * 1024
+    RATE_LIMIT = int(args.rate * 1024 * 1024)
+    CONN_RATE_LIMIT = int(args.conn_rate * 1024 * 1024)
     if(args.server):
-        run_server(args.server)
+        run_server(args.server, args.workers)
     elif(args.client):
-        run_client(*args.client[:2])
+        run_client(*args.client[:2], compress=args.compress,
+                   digest=not args.no_digest)
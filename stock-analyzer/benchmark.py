@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from kline_store import KlineStore
+from query_server import ask
+from stock_database import generate_base
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+'''
+benchmarks for stock_database.py over synthetic data
+
+python benchmark.py load [-n FILES] [-d DAYS] [-w 0 1 2 4]
+python benchmark.py query [-n FILES] [-r REQUESTS] [-c CLIENTS] [-a APPENDS]
+'''
+
+
+def make_klines(root, count, days):
+    # kline files as stock_request_aio.py saves them, ~1% suspended days
+    for i in range(count):
+        rnd = random.Random(i)
+        price = rnd.uniform(5, 50)
+        kline = []
+        for day in range(days):
+            price = round(price * rnd.uniform(0.95, 1.05), 2)
+            close = 0 if rnd.random() < 0.01 else price
+            kline.append([20180101 + day, price, price, price, close,
+                          rnd.randrange(100000)])
+        with open(os.path.join(root, f"{600000 + i}.SS.json"), "w") as f:
+            json.dump(kline, f)
+
+
+def bench_load(args):
+    workers = args.workers or [0, *range(1, os.cpu_count() + 1)]
+    with tempfile.TemporaryDirectory() as root:
+        folder = os.path.join(root, "short")
+        os.makedirs(folder)
+        make_klines(folder, args.files, args.days)
+        for n in workers:
+            db_name = os.path.join(root, f"{n}.kline")
+            start = time.perf_counter()
+            # no progress bar in the numbers
+            with contextlib.redirect_stderr(io.StringIO()):
+                generate_base(folder, db_name, n)
+            cost = time.perf_counter() - start
+            name = "in process" if n == 0 else f"{n} workers"
+            print(f"{name:>12}: {cost:6.2f}s, {args.files / cost:8.0f} files/s")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def server_process(db_name):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "query_server.py"), db_name,
+         "-p", str(port), "-w", "0.1"], stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while(1):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                if time.time() > deadline or proc.poll() is not None:
+                    raise RuntimeError("query server did not start")
+                time.sleep(0.05)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+QUERIES = [("search", 3, 1), ("search", 5, 0), ("streak", 5, 1),
+           ("return", 5, 8), ("top", 3, 20), ("indicators", "600001.SS")]
+
+
+async def query_client(port, count, costs, versions):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for i in range(count):
+        start = time.perf_counter()
+        result = await ask(reader, writer, *QUERIES[i % len(QUERIES)])
+        costs.append(time.perf_counter() - start)
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        versions.add(result["version"])
+    writer.close()
+
+
+async def publish(db_name, appends, seconds):
+    # new days published while the clients query, as append_one_day does
+    store = KlineStore.load(db_name, mmap=False)
+    date = int(store.dates.max())
+    for _ in range(appends):
+        await asyncio.sleep(seconds / (appends + 1))
+        date += 1
+        store.append_day(date, store.codes, store.last(1)[:, 0] *
+                         np.random.uniform(0.95, 1.05, len(store.codes)))
+        store.save(db_name)
+
+
+async def run_queries(port, db_name, args):
+    costs = []
+    versions = set()
+    per_client = args.requests // args.clients
+    start = time.perf_counter()
+    await asyncio.gather(
+        publish(db_name, args.appends, args.requests / 2000),
+        *(query_client(port, per_client, costs, versions)
+          for _ in range(args.clients)))
+    return costs, versions, time.perf_counter() - start
+
+
+def report_latency(name, costs):
+    costs = sorted(costs)
+    pick = lambda q: costs[min(int(q * len(costs)), len(costs) - 1)] * 1000
+    print(f"{name}: p50 {pick(0.5):.2f}ms, p99 {pick(0.99):.2f}ms, "
+          f"max {costs[-1] * 1000:.2f}ms over {len(costs)}")
+
+
+def bench_query(args):
+    with tempfile.TemporaryDirectory() as root:
+        folder = os.path.join(root, "short")
+        os.makedirs(folder)
+        make_klines(folder, args.files, 60)
+        db_name = os.path.join(root, "stocks.kline")
+        with contextlib.redirect_stderr(io.StringIO()):
+            generate_base(folder, db_name, 0)
+
+        cli = []
+        for _ in range(3):
+            start = time.perf_counter()
+            subprocess.run([sys.executable,
+                            os.path.join(HERE, "stock_database.py"),
+                            "-s", "3", "1", db_name],
+                           stdout=subprocess.DEVNULL, check=True)
+            cli.append(time.perf_counter() - start)
+        report_latency("stock_database.py -s", cli)
+
+        with server_process(db_name) as port:
+            costs, versions, cost = asyncio.run(
+                run_queries(port, db_name, args))
+        report_latency(f"query server, {args.clients} clients", costs)
+        print(f"{len(costs) / cost:.0f} queries/s, answered from "
+              f"{len(versions)} snapshots with {args.appends} published")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("load", help="generate a .kline store per worker count")
+    p.add_argument("-n", "--files", type=int, default=5000)
+    p.add_argument("-d", "--days", type=int, default=250,
+                   help="days of history per file")
+    p.add_argument("-w", "--workers", type=int, nargs="+",
+                   help="process counts, 0 parses in process (default 0..cpus)")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("query", help="query server latency against the cli")
+    p.add_argument("-n", "--files", type=int, default=5000)
+    p.add_argument("-r", "--requests", type=int, default=5000)
+    p.add_argument("-c", "--clients", type=int, default=4)
+    p.add_argument("-a", "--appends", type=int, default=3,
+                   help="days published while querying")
+    p.set_defaults(func=bench_query)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,116 @@
+'''
+indicators of every stock, moved on one day at a time as prices are pushed
+into a KlineStore. a push costs O(1) per stock, so the state of a store is
+kept up to date by every append instead of being recomputed by the screens
+'''
+
+import numpy as np
+
+MEAN_N = 20
+EMA_N = 12
+RETURN_N = 5
+
+# prev_* hold the state before the last day, so that day can be pushed again
+STATE = np.dtype([
+    ("count", np.int64),
+    ("total", np.float64),
+    ("total_sq", np.float64),
+    ("ema", np.float64),
+    ("up", np.int64),
+    ("down", np.int64),
+    ("ret", np.float64),
+    ("prev_ema", np.float64),
+    ("prev_up", np.int64),
+    ("prev_down", np.int64),
+])
+
+
+def empty_state(stocks):
+    state = np.zeros(stocks, dtype=STATE)
+    state["ret"] = np.nan
+    return state
+
+
+def advance(s, price, prev, back):
+    # ema, streaks and return of s moved on to price from the prev_* state
+    alpha = 2 / (EMA_N + 1)
+    first = s["count"] == 1
+    s["ema"] = np.where(first, price,
+                        s["prev_ema"] + alpha * (price - s["prev_ema"]))
+    # a flat day counts as both, NaN (no day before) as neither
+    diff = price - prev
+    s["up"] = np.where(diff >= 0, s["prev_up"] + 1, 0)
+    s["down"] = np.where(diff <= 0, s["prev_down"] + 1, 0)
+    s["ret"] = price / back - 1
+
+
+def push(state, rows, price, prev, leaving, back):
+    '''
+    move rows on to a new day at price. prev is the price of the day before,
+    leaving the one dropping out of the MEAN_N window and back the one
+    RETURN_N days before, NaN where a stock has no such day
+    '''
+    s = state[rows]
+    s["count"] += 1
+    s["total"] += price - np.nan_to_num(leaving)
+    s["total_sq"] += price * price - np.nan_to_num(leaving) ** 2
+    s["prev_ema"] = s["ema"]
+    s["prev_up"] = s["up"]
+    s["prev_down"] = s["down"]
+    advance(s, price, prev, back)
+    state[rows] = s
+
+
+def repush(state, rows, price, old, prev, back):
+    '''
+    replace the price old of the last day of rows with price
+    '''
+    s = state[rows]
+    s["total"] += price - old
+    s["total_sq"] += price * price - old * old
+    advance(s, price, prev, back)
+    state[rows] = s
+
+
+def streak(window, up):
+    # days every row has been going up (or down) up to its last column
+    diff = np.diff(window, axis=1)
+    ok = (diff >= 0 if up else diff <= 0)[:, ::-1]
+    return np.where(ok.all(axis=1), ok.shape[1], ok.argmin(axis=1))
+
+
+def replay(window):
+    '''
+    state of every stock after pushing its right aligned, NaN padded window,
+    the same as pushing it one day at a time
+    '''
+    state = empty_state(len(window))
+    state["count"] = (~np.isnan(window)).sum(axis=1)
+    recent = np.nan_to_num(window[:, -MEAN_N:])
+    state["total"] = recent.sum(axis=1)
+    state["total_sq"] = (recent * recent).sum(axis=1)
+    alpha = 2 / (EMA_N + 1)
+    ema = np.full(len(window), np.nan)
+    for day in range(window.shape[1]):
+        state["prev_ema"] = np.nan_to_num(ema)
+        # the padding is all on the left, once a row has a price it goes on
+        ema = np.where(np.isnan(ema), window[:, day],
+                       ema + alpha * (window[:, day] - ema))
+    state["ema"] = np.nan_to_num(ema)
+    for key, up in (("up", True), ("down", False)):
+        state[key] = streak(window, up)
+        state["prev_" + key] = streak(window[:, :-1], up)
+    if window.shape[1] > RETURN_N:
+        state["ret"] = window[:, -1] / window[:, -1 - RETURN_N] - 1
+    return state
+
+
+def rolling_mean(state):
+    # NaN until a stock has MEAN_N days
+    return np.where(state["count"] >= MEAN_N, state["total"] / MEAN_N,
+                    np.nan)
+
+
+def rolling_std(state):
+    mean = rolling_mean(state)
+    return np.sqrt(np.maximum(state["total_sq"] / MEAN_N - mean * mean, 0))
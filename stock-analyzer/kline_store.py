@@ -0,0 +1,246 @@
+import json
+import os
+
+import numpy as np
+
+from indicators import (MEAN_N, RETURN_N, empty_state, push, replay,
+                        repush)
+
+# a database name with this suffix is a KlineStore directory, anything else
+# stays a TinyDB json file
+STORE_SUFFIX = ".kline"
+MANIFEST = "store.json"
+STORE_ARRAYS = ("codes", "dates", "prices", "head", "state")
+
+
+def is_store(db_name):
+    return db_name.rstrip("/\\").endswith(STORE_SUFFIX)
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class KlineStore:
+    '''
+    the last capacity closing prices of every stock, zero (suspended) days
+    left out. every row of prices is a ring buffer written twice, at col and
+    col + capacity, so the last n prices of a stock are always the slice
+    ending at head + capacity, oldest first. dates holds the yyyymmdd of
+    every price the same way, slots never written are NaN (0 in dates).
+    state holds the indicators of every stock, pushed on by every append
+    '''
+
+    def __init__(self, codes, dates, prices, head, state):
+        self.codes = codes
+        self.dates = dates
+        self.prices = prices
+        self.head = head
+        self.state = state
+        self._rows = None
+
+    @property
+    def capacity(self):
+        return self.prices.shape[1] // 2
+
+    @classmethod
+    def allocate(cls, codes, capacity):
+        '''
+        a store of codes with room for capacity days each, all empty
+        '''
+        stocks = len(codes)
+        return cls(np.array(codes, dtype=str),
+                   np.zeros((stocks, 2 * capacity), dtype=np.int64),
+                   np.full((stocks, 2 * capacity), np.nan),
+                   np.zeros(stocks, dtype=np.int64), empty_state(stocks))
+
+    @classmethod
+    def empty(cls, capacity):
+        return cls.allocate([], capacity)
+
+    @classmethod
+    def from_klines(cls, klines, capacity):
+        '''
+        build from (code, dates, prices) of every stock, dates ascending
+        '''
+        klines = list(klines)
+        store = cls.allocate([code for code, _, _ in klines], capacity)
+        for row, (_, dates, prices) in enumerate(klines):
+            store.set_row(row, dates, prices)
+        store.rebuild_state()
+        return store
+
+    def set_row(self, row, dates, prices):
+        '''
+        fill an empty row with the last capacity of dates and prices, dates
+        ascending. rebuild_state once all rows are set
+        '''
+        capacity = self.capacity
+        dates = np.asarray(dates, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        # zero (suspended) prices are left out
+        hit = prices != 0
+        dates = dates[hit][-capacity:]
+        prices = prices[hit][-capacity:]
+        count = len(prices)
+        for offset in (0, capacity):
+            self.dates[row, offset:offset + count] = dates
+            self.prices[row, offset:offset + count] = prices
+        self.head[row] = count % capacity
+
+    def rebuild_state(self):
+        self.state = replay(self.last(self.capacity))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        open the current snapshot of path, dates and prices are memory mapped
+        read only unless mmap is False
+        '''
+        manifest = read_manifest(path)
+        if manifest is None:
+            raise FileNotFoundError(f"no kline store at {path}")
+        files = manifest["files"]
+        mode = "r" if mmap else None
+        return cls(np.load(os.path.join(path, files["codes"])),
+                   np.load(os.path.join(path, files["dates"]), mmap_mode=mode),
+                   np.load(os.path.join(path, files["prices"]), mmap_mode=mode),
+                   np.load(os.path.join(path, files["head"])),
+                   np.load(os.path.join(path, files["state"])))
+
+    def save(self, path):
+        '''
+        write a new snapshot next to the current one and switch the manifest
+        over to it in one rename, so readers never see half of an update.
+        the previous snapshot stays for readers still opening it
+        '''
+        os.makedirs(path, exist_ok=True)
+        old = read_manifest(path)
+        generation = old["generation"] + 1 if old else 1
+        files = {}
+        for key in STORE_ARRAYS:
+            files[key] = f"{key}-{generation}.npy"
+            np.save(os.path.join(path, files[key]), getattr(self, key))
+        manifest = {"generation": generation, "files": files,
+                    "stocks": len(self.codes), "capacity": self.capacity}
+        tmp = os.path.join(path, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(path, MANIFEST))
+        for key in STORE_ARRAYS:
+            try:
+                os.remove(os.path.join(path, f"{key}-{generation - 2}.npy"))
+            except OSError:
+                pass
+
+    @property
+    def rows(self):
+        # code -> row, only built when a lookup needs it
+        if self._rows is None:
+            self._rows = {code: row for row, code in enumerate(self.codes)}
+        return self._rows
+
+    def append_day(self, date, codes, prices):
+        '''
+        push the prices of date onto every stock, or overwrite them if date
+        is already its last day. unknown codes get a row of their own
+        '''
+        new_codes = [code for code in dict.fromkeys(codes)
+                     if code not in self.rows]
+        if not self.prices.flags.writeable:
+            self.dates = np.array(self.dates)
+            self.prices = np.array(self.prices)
+        capacity = self.capacity
+        if new_codes:
+            self.codes = np.concatenate([self.codes, new_codes])
+            self.dates = np.vstack([self.dates, np.zeros(
+                (len(new_codes), 2 * capacity), dtype=np.int64)])
+            self.prices = np.vstack([self.prices, np.full(
+                (len(new_codes), 2 * capacity), np.nan)])
+            self.head = np.concatenate([self.head, np.zeros(
+                len(new_codes), dtype=np.int64)])
+            self.state = np.concatenate([self.state,
+                                         empty_state(len(new_codes))])
+            self._rows = None
+        rows = np.fromiter((self.rows[code] for code in codes), np.int64,
+                           len(codes))
+        prices = np.asarray(prices, dtype=np.float64)
+        # zero (suspended) prices are not included
+        hit = prices != 0
+        rows = rows[hit]
+        prices = prices[hit]
+        last = (self.head[rows] - 1) % capacity
+        last_date = self.dates[rows, last]
+        if len(rows) and (date < last_date).any():
+            raise ValueError(f"{date} is older than the last day "
+                             f"{last_date.max()}")
+        again = last_date == date
+        col = np.where(again, last, self.head[rows])
+        self.update_state(rows[again], col[again], prices[again])
+        self.update_state(rows[~again], col[~again], prices[~again], True)
+        for offset in (0, capacity):
+            self.dates[rows, col + offset] = date
+            self.prices[rows, col + offset] = prices
+        self.head[rows] = (col + 1) % capacity
+
+    def last_day(self, code):
+        '''
+        the last date code has a price of, 0 if none
+        '''
+        row = self.rows.get(code)
+        if row is None:
+            return 0
+        return int(self.dates[row, (self.head[row] - 1) % self.capacity])
+
+    def merge(self, klines):
+        '''
+        append (code, dates, prices) of every stock, dates ascending. days
+        before the last one the store has of a stock are skipped, the last
+        one itself is overwritten
+        '''
+        days = {}
+        for code, dates, prices in klines:
+            last = self.last_day(code)
+            # anything older would drop out of the ring anyway
+            keep = [i for i, price in enumerate(prices)
+                    if price != 0 and dates[i] >= last][-self.capacity:]
+            for i in keep:
+                codes, day_prices = days.setdefault(dates[i], ([], []))
+                codes.append(code)
+                day_prices.append(prices[i])
+        for date in sorted(days):
+            self.append_day(date, *days[date])
+
+    def update_state(self, rows, col, prices, new_day=False):
+        # the slots are read before the new prices are written to col
+        def back(n):
+            return self.prices[rows, (col - n) % self.capacity]
+        if new_day:
+            push(self.state, rows, prices, back(1), back(MEAN_N),
+                 back(RETURN_N))
+        else:
+            repush(self.state, rows, prices, back(0), back(1),
+                   back(RETURN_N))
+
+    def window(self, code, n):
+        '''
+        dates and prices of the last n days of code, views into the store
+        '''
+        row = self.rows[code]
+        n = min(n, self.capacity)
+        end = self.head[row] + self.capacity
+        return self.dates[row, end - n:end], self.prices[row, end - n:end]
+
+    def last(self, n):
+        '''
+        the last n prices of every stock, right aligned and NaN padded
+        '''
+        window = np.full((len(self.codes), n), np.nan)
+        k = min(n, self.capacity)
+        cols = (self.head + self.capacity - k)[:, None] + np.arange(k)
+        window[:, n - k:] = np.take_along_axis(self.prices, cols, axis=1)
+        return window
@@ -0,0 +1,169 @@
+'''
+keeps a database hot in memory and answers screens over a socket, a json
+request per line and a json answer per line
+
+{"screen": "search", "args": [3, 1]}             like stock_database.py -s 3 1
+{"screen": "streak", "args": [5, 1]}             -k 5 1
+{"screen": "return", "args": [3, 10]}            -r 3 10
+{"screen": "top", "args": [3, 20]}               -t 3 20
+{"screen": "indicators", "args": ["600001.SS"]}  -i 600001.SS
+
+-> {"rows": [[code, value], ...], "version": ..., "ms": ...}
+   or {"error": ..., "ms": ...}
+
+python query_server.py stocks.kline [-p PORT] [-u SOCKET] [-w SECONDS]
+'''
+import argparse
+import asyncio
+import json
+import os
+import time
+from functools import partial
+
+from kline_store import is_store, read_manifest
+from stock_database import (find_indicators, find_last_n, find_return,
+                            find_streak, find_top, load_store)
+
+PORT = 11299
+WATCH_INTERVAL = 0.5
+
+
+def flag(value):
+    return bool(int(value))
+
+
+def percent(value):
+    return float(value) / 100
+
+
+def positive(value):
+    # days and counts, 0 or less would index the history from the wrong end
+    value = int(value)
+    if value <= 0:
+        raise ValueError(f"{value} is not positive")
+    return value
+
+
+# screen -> the function answering it and the types of its arguments
+SCREENS = {
+    "search": (find_last_n, (positive, flag)),
+    "streak": (find_streak, (positive, flag)),
+    "return": (find_return, (positive, percent)),
+    "top": (find_top, (positive, positive)),
+    "indicators": (find_indicators, (str,)),
+}
+
+
+def plain(value):
+    # numpy values and arrays to what json takes
+    return value.tolist() if hasattr(value, "tolist") else value
+
+
+class HotStore:
+    '''
+    the newest snapshot of db_name, swapped in whole once one is published.
+    current is (version, store) and changes in one assignment, a request
+    keeps the pair it started with
+    '''
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.current = (None, None)
+        self.reload()
+
+    def published(self):
+        # the generation of a .kline store, the mtime of a TinyDB file
+        if is_store(self.db_name):
+            manifest = read_manifest(self.db_name)
+            return manifest and manifest["generation"]
+        return os.stat(self.db_name).st_mtime_ns
+
+    def reload(self):
+        version = self.published()
+        if version == self.current[0]:
+            return False
+        self.current = (version, load_store(self.db_name))
+        return True
+
+    async def watch(self, interval=WATCH_INTERVAL):
+        loop = asyncio.get_running_loop()
+        while(1):
+            await asyncio.sleep(interval)
+            try:
+                if await loop.run_in_executor(None, self.reload):
+                    print(f"reloaded version {self.current[0]}")
+            except (OSError, ValueError, KeyError) as e:
+                # a snapshot being written or already replaced, the next
+                # look finds a complete one
+                print(f"reload failed: {e!r}")
+
+
+def answer(hot, line):
+    version, store = hot.current
+    try:
+        request = json.loads(line)
+        func, types = SCREENS[request["screen"]]
+        args = request["args"]
+        if len(args) != len(types):
+            raise ValueError(f"{request['screen']} takes {len(types)} args")
+        rows = func(store, *(t(arg) for t, arg in zip(types, args)))
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        return {"error": repr(e)}
+    return {"rows": [[plain(key), plain(value)] for key, value in rows],
+            "version": version}
+
+
+async def serve_client(hot, reader, writer):
+    try:
+        while(1):
+            line = await reader.readline()
+            if not line:
+                break
+            start = time.perf_counter()
+            result = answer(hot, line)
+            result["ms"] = (time.perf_counter() - start) * 1000
+            writer.write(json.dumps(result).encode() + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_server(db_name, host, port, unix=None, interval=WATCH_INTERVAL):
+    hot = HotStore(db_name)
+    handler = partial(serve_client, hot)
+    if unix:
+        server = await asyncio.start_unix_server(handler, unix)
+        print(f"serving {db_name} on {unix}")
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print(f"serving {db_name} on {host}:{port}")
+    watcher = asyncio.ensure_future(hot.watch(interval))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+async def ask(reader, writer, screen, *args):
+    writer.write(json.dumps({"screen": screen, "args": args}).encode() +
+                 b"\n")
+    return json.loads(await reader.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=PORT)
+    parser.add_argument("-u", "--unix", help="listen on this unix socket")
+    parser.add_argument("-w", "--watch", type=float, default=WATCH_INTERVAL,
+                        help="seconds between looks for a new snapshot")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_server(args.database, args.host, args.port,
+                               args.unix, args.watch))
+    except KeyboardInterrupt:
+        pass
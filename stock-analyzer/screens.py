@@ -0,0 +1,67 @@
+'''
+screens over a window, a (stocks x days) float64 matrix of the latest prices
+of every stock, right aligned and NaN padded. a NaN compares false, so a
+stock without enough history never passes a screen
+'''
+
+import numpy as np
+
+
+def day_changes(window):
+    '''
+    change and percent change of every day against the day before it
+    '''
+    diff = np.diff(window, axis=1)
+    return diff, diff / window[:, :-1]
+
+
+def moves(diff, up):
+    # a flat day counts as both, as it always did
+    return diff >= 0 if up else diff <= 0
+
+
+def streak_all(window, up):
+    '''
+    rows that went up (or down) every day of window, biggest total move
+    first, and the percent changes
+    '''
+    diff, diff_pct = day_changes(window)
+    hit = np.flatnonzero(moves(diff, up).all(axis=1))
+    score = np.abs(diff_pct[hit]).sum(axis=1)
+    return hit[np.argsort(-score, kind="stable")], diff_pct
+
+
+def screen_streak(length, min_days):
+    '''
+    rows with a streak of at least min_days, longest first
+    '''
+    hit = np.flatnonzero(length >= min_days)
+    return hit[np.argsort(-length[hit], kind="stable")]
+
+
+def total_return(window):
+    return window[:, -1] / window[:, 0] - 1
+
+
+def screen_return(ret, threshold):
+    '''
+    rows whose return is at least threshold, or at most threshold when it
+    is negative, biggest move first
+    '''
+    hit = np.flatnonzero(ret >= threshold if threshold >= 0
+                         else ret <= threshold)
+    return hit[np.argsort(-np.abs(ret[hit]), kind="stable")]
+
+
+def top_moves(ret, k):
+    '''
+    the k rows with the biggest absolute return, biggest first
+    '''
+    move = np.abs(ret)
+    valid = np.flatnonzero(~np.isnan(move))
+    k = min(k, len(valid))
+    if k == 0:
+        return valid
+    # only the k winners get sorted
+    top = valid[np.argpartition(-move[valid], k - 1)[:k]]
+    return top[np.argsort(-move[top], kind="stable")]
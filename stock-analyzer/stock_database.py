@@ -1,116 +1,349 @@
 import argparse
+import asyncio
 import csv
 import json
 import os
-import re
 import time
 from collections import namedtuple
-from itertools import tee
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from operator import itemgetter
 
-from tinydb import Query, TinyDB
+import numpy as np
+from tinydb import TinyDB
 from tinydb.middlewares import CachingMiddleware
 from tinydb.storages import JSONStorage
 from tqdm import tqdm
 
-from stock_request_aio import KEEP_N
+from indicators import EMA_N, MEAN_N, RETURN_N, rolling_mean, rolling_std
+from kline_store import STORE_SUFFIX, KlineStore, is_store
+from screens import (screen_return, screen_streak, streak_all, top_moves,
+                     total_return)
+from symbol_registry import day_of
+from stock_request_aio import (BUNDLE_SUFFIX, HOST, KEEP_N, KLINE_SINCE,
+                               KLINE_URL, candle_of, collect_names,
+                               fetch_klines, get_today_format_str)
 
 DayInfo = namedtuple(
     "DayInfo", ["date", "open", "high", "low", "price", "amount"])
 
+# the columns of a kline row the database keeps
+DATE = DayInfo._fields.index("date")
+PRICE = DayInfo._fields.index("price")
+# kline files handed to a loader process at a time
+LOAD_CHUNK = 64
+# code -> the yyyymmdd its kline was last fetched, beside the store
+FETCHED = "fetched.json"
+
 CachingMiddleware.WRITE_CACHE_SIZE = 5000
 
 
-def generate_base(path_name, db_name):
+def read_columns(path, keep=None):
+    '''
+    name, dates and prices of a kline file, dates ascending. only the two
+    columns are picked out of the rows, with keep the zero prices are left
+    out and the last keep kept
+    '''
+    with open(path) as f:
+        rows = json.load(f)
+    rows.sort(key=itemgetter(DATE))
+    dates = [row[DATE] for row in rows]
+    prices = [row[PRICE] for row in rows]
+    if keep:
+        valid = [i for i, price in enumerate(prices) if price != 0][-keep:]
+        dates = [dates[i] for i in valid]
+        prices = [prices[i] for i in valid]
+    return os.path.splitext(os.path.basename(path))[0], dates, prices
+
+
+def load_klines(path_name, files, workers=None, keep=None):
+    '''
+    read_columns of files in path_name in order, parsed by a pool of workers
+    processes (a cpu each by default), or in this process when workers is 0
+    '''
+    paths = [os.path.join(path_name, file) for file in files]
+    read = partial(read_columns, keep=keep)
+    if workers == 0:
+        yield from map(read, paths)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(read, paths, chunksize=LOAD_CHUNK)
+
+
+def generate_store(path_name, db_name, workers=None):
+    files = os.listdir(path_name)
+    store = KlineStore.allocate([os.path.splitext(file)[0] for file in files],
+                                KEEP_N)
+    klines = load_klines(path_name, files, workers, KEEP_N)
+    for row, (_, dates, prices) in enumerate(tqdm(klines, total=len(files))):
+        store.set_row(row, dates, prices)
+    store.rebuild_state()
+    store.save(db_name)
+
+
+def generate_base(path_name, db_name, workers=None):
+    if is_store(db_name):
+        generate_store(path_name, db_name, workers)
+        return
     with TinyDB(db_name, storage=CachingMiddleware(JSONStorage)) as db:
         db.purge_tables()
         table = db.table('all_stock')
 
         files = os.listdir(path_name)
-        bar = tqdm(total=len(files))
-        for file in files:
-            bar.update(1)
-            with open(os.path.join(path_name, file)) as f:
-                obj = json.load(f)
-            kline = []
-            for item in obj:
-                di = DayInfo(*item)
-                kline.append((di.date, di.price))
-            kline.sort()
-            name = os.path.splitext(file)[0]
-            table.insert({"name": name, "kline": kline})
-        bar.close()
+        klines = load_klines(path_name, files, workers)
+        table.insert_multiple(
+            {"name": name, "kline": list(zip(dates, prices))}
+            for name, dates, prices in tqdm(klines, total=len(files)))
+
+
+def day_rows(day_file):
+    '''
+    (code, last price) of every stock of a daily csv, streamed, or of a
+    daily npz bundle
+    '''
+    if day_file.endswith(BUNDLE_SUFFIX):
+        codes, prices = read_day(day_file)
+        yield from zip(codes.tolist(), prices.tolist())
+        return
+    with open(day_file, encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield row["code"], float(row["last_px"])
+
+
+def read_day(day_file):
+    '''
+    codes and last prices of a daily csv, or the arrays of a daily npz
+    bundle as they are
+    '''
+    if day_file.endswith(BUNDLE_SUFFIX):
+        with np.load(day_file) as bundle:
+            return bundle["code"], bundle["last_px"]
+    codes = []
+    prices = []
+    for code, price in day_rows(day_file):
+        codes.append(code)
+        prices.append(price)
+    return codes, prices
+
+
+def append_store(day_file, db_name):
+    try:
+        store = KlineStore.load(db_name, mmap=False)
+    except FileNotFoundError:
+        store = KlineStore.empty(KEEP_N)
+    codes, prices = read_day(day_file)
+    store.append_day(day_of(day_file), codes, prices)
+    store.save(db_name)
+
+
+def count_rows(path, chunk_size=1 << 20):
+    '''
+    data rows of a csv file, counted a chunk at a time
+    '''
+    lines = 0
+    tail = b"\n"
+    with open(path, "rb") as f:
+        while(1):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+            tail = chunk[-1:]
+    # minus the header, plus a last row without a newline
+    return max(lines - 1 + (tail != b"\n"), 0)
+
+
+def count_day(day_file):
+    if day_file.endswith(BUNDLE_SUFFIX):
+        with np.load(day_file) as bundle:
+            return len(bundle["code"])
+    return count_rows(day_file)
 
 
 def append_one_day(day_file, db_name):
-    with open(day_file, encoding="utf-8") as f,\
-            TinyDB(db_name, storage=CachingMiddleware(JSONStorage)) as db:
+    if is_store(db_name):
+        append_store(day_file, db_name)
+        return
+    date = day_of(day_file)
+    with TinyDB(db_name, storage=CachingMiddleware(JSONStorage)) as db:
         table = db.table('all_stock')
-        Stock = Query()
-        reader = csv.DictReader(f)
-        reader, counter = tee(reader, 2)
-        bar = tqdm(total=len(list(counter)))
-        for row in reader:
-            bar.update(1)
-            date = re.split(r"[^\d]", day_file)[0]
-            code = row["code"]
-            price = row["last_px"]
-            info = [int(date), float(price)]
-            result = table.get(Stock.name == code)
-            if result:
+        # one scan of the table instead of a query per row, every change
+        # stays in memory until the single write at the end
+        stocks = {stock["name"]: stock for stock in table.all()}
+        updated = {}
+        inserted = {}
+        for code, price in tqdm(day_rows(day_file),
+                                total=count_day(day_file)):
+            info = [date, price]
+            if code in inserted:
+                if(info[1] != 0):
+                    inserted[code]["kline"].append(info)
+            elif code in stocks:
+                result = stocks[code]
                 # zero not included
                 if(info[1] != 0):
                     result["kline"].append(info)
-                    result["kline"] = result["kline"][-KEEP_N:]
-                    table.write_back([result])
+                    del result["kline"][:-KEEP_N]
+                    updated[result.doc_id] = result
             else:
-                kline = [info]
-                table.insert({"name": code, "kline": kline})
-        bar.close()
+                inserted[code] = {"name": code, "kline": [info]}
+        table.write_back(list(updated.values()))
+        table.insert_multiple(inserted.values())
+
+
+def read_fetched(db_name):
+    try:
+        with open(os.path.join(db_name, FETCHED)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_fetched(db_name, fetched):
+    tmp = os.path.join(db_name, FETCHED + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(fetched, f)
+    os.replace(tmp, os.path.join(db_name, FETCHED))
+
+
+def update_store(db_name, host=HOST, prune_days=None):
+    '''
+    fetch the klines of the stocks in the daily csv files of the cwd right
+    into the store. a stock is asked only for the days from the last one the
+    store has of it, and not at all once fetched today or current
+    '''
+    if not is_store(db_name):
+        raise ValueError(f"{db_name} is not a {STORE_SUFFIX} store")
+    try:
+        store = KlineStore.load(db_name, mmap=False)
+    except FileNotFoundError:
+        store = KlineStore.empty(KEEP_N)
+    fetched = read_fetched(db_name)
+    today = int(get_today_format_str())
+    jobs = []
+    for code in sorted(map(itemgetter(0), collect_names(prune_days))):
+        last = store.last_day(code)
+        if fetched.get(code) == today or last >= today:
+            continue
+        url = host + KLINE_URL.format(code)
+        if last:
+            url += KLINE_SINCE.format(last)
+        jobs.append((code, url))
+    klines = []
+
+    def keep(code, result):
+        _, rows = candle_of(result)
+        rows.sort(key=itemgetter(DATE))
+        klines.append((code, [row[DATE] for row in rows],
+                       [row[PRICE] for row in rows]))
+
+    failed = asyncio.run(fetch_klines(jobs, keep))
+    store.merge(klines)
+    store.save(db_name)
+    for code, _, _ in klines:
+        fetched[code] = today
+    write_fetched(db_name, fetched)
+    return failed
+
+
+def load_store(db_name):
+    if is_store(db_name):
+        return KlineStore.load(db_name)
+    with TinyDB(db_name, storage=CachingMiddleware(JSONStorage)) as db:
+        stocks = list(db.table('all_stock'))
+    return KlineStore.from_klines(
+        ((stock["name"], [d for d, _ in stock["kline"]],
+          [p for _, p in stock["kline"]]) for stock in stocks), KEEP_N)
+
+
+def find_last_n(store, last_n, up_or_down):
+    order, diff_pct = streak_all(store.last(last_n + 1), up_or_down)
+    # latest day first
+    return [(store.codes[row], diff_pct[row, ::-1]) for row in order]
+
+
+def find_streak(store, min_days, up_or_down):
+    length = store.state["up" if up_or_down else "down"]
+    return [(store.codes[row], length[row])
+            for row in screen_streak(length, min_days)]
+
+
+def last_return(store, last_n):
+    # kept by the indicators for RETURN_N days, any other span is computed
+    if last_n == RETURN_N:
+        return store.state["ret"]
+    return total_return(store.last(last_n + 1))
+
+
+def find_return(store, last_n, threshold):
+    ret = last_return(store, last_n)
+    return [(store.codes[row], ret[row])
+            for row in screen_return(ret, threshold)]
+
+
+def find_top(store, last_n, k):
+    ret = last_return(store, last_n)
+    return [(store.codes[row], ret[row]) for row in top_moves(ret, k)]
+
+
+def find_indicators(store, code):
+    row = store.rows[code]
+    state = store.state[row:row + 1]
+    _, prices = store.window(code, 1)
+    return [("price", prices[-1]),
+            (f"mean{MEAN_N}", rolling_mean(state)[0]),
+            (f"std{MEAN_N}", rolling_std(state)[0]),
+            (f"ema{EMA_N}", state["ema"][0]),
+            ("up", state["up"][0]),
+            ("down", state["down"][0]),
+            (f"return{RETURN_N}", state["ret"][0])]
 
 
 def search_last_n(last_n, up_or_down, db_name):
-    def ups(diff): return diff >= 0
-    def downs(diff): return diff <= 0
-    opertor = up_or_down and ups or downs
-
-    def print_data(all_data):
-        for data in all_data:
-            data["kline_diff_pct"] = [
-                f"{(d * 100):.2f}%" for d in data["kline_diff_pct"]]
-            print(f'{data["name"]}, {data["kline_diff_pct"]}')
-
-    def shorten_kline(item):
-        item["kline"] = list(reversed(item["kline"][-(last_n + 1):]))
-        return item
-
-    def sum_kline(item):
-        total = 0
-        for n in item["kline_diff_pct"]:
-            total += abs(n)
-        return (total, len(item["kline_diff_pct"]))
+    now = time.perf_counter()
+    found = find_last_n(load_store(db_name), last_n, up_or_down)
+    take_time = (time.perf_counter() - now) * 1000
+    for code, diff_pct in found:
+        pct = [f"{(d * 100):.2f}%" for d in diff_pct]
+        print(f'{code}, {pct}')
+    print(f"take {take_time:.2f}ms to search")
 
+
+def search_streak(min_days, up_or_down, db_name):
     now = time.perf_counter()
-    with TinyDB(db_name, storage=CachingMiddleware(JSONStorage)) as db:
-        table = db.table('all_stock')
-        last_n_data = list(map(shorten_kline, table))
-        for data in last_n_data:
-            data["up_down"] = []
-            data["kline_diff"] = []
-            data["kline_diff_pct"] = []
-            for i in range(len(data["kline"]) - 1):
-                diff = data["kline"][i][1] - data["kline"][i + 1][1]
-                diff_pct = diff / data["kline"][i + 1][1]
-                data["kline_diff"].append(diff)
-                data["kline_diff_pct"].append(diff_pct)
-                data["up_down"].append(opertor(diff))
-
-        filtered_data = list(
-            filter(lambda data: all(data["up_down"]), last_n_data))
-        filtered_data_sorted = sorted(
-            filtered_data, key=sum_kline, reverse=True)
-        take_time = (time.perf_counter() - now) * 1000
-        print_data(filtered_data_sorted)
-        print(f"take {take_time:.2f}ms to search")
+    found = find_streak(load_store(db_name), min_days, up_or_down)
+    take_time = (time.perf_counter() - now) * 1000
+    for code, length in found:
+        print(f'{code}, {length} days')
+    print(f"take {take_time:.2f}ms to search")
+
+
+def search_return(last_n, threshold, db_name):
+    now = time.perf_counter()
+    found = find_return(load_store(db_name), last_n, threshold)
+    take_time = (time.perf_counter() - now) * 1000
+    for code, ret in found:
+        print(f'{code}, {(ret * 100):.2f}%')
+    print(f"take {take_time:.2f}ms to search")
+
+
+def search_top(last_n, k, db_name):
+    now = time.perf_counter()
+    found = find_top(load_store(db_name), last_n, k)
+    take_time = (time.perf_counter() - now) * 1000
+    for code, ret in found:
+        print(f'{code}, {(ret * 100):.2f}%')
+    print(f"take {take_time:.2f}ms to search")
+
+
+def show_indicators(code, db_name):
+    values = dict(find_indicators(load_store(db_name), code))
+    print(f"price {values['price']:.2f}, "
+          f"mean{MEAN_N} {values[f'mean{MEAN_N}']:.2f}, "
+          f"std{MEAN_N} {values[f'std{MEAN_N}']:.2f}, "
+          f"ema{EMA_N} {values[f'ema{EMA_N}']:.2f}, "
+          f"up {values['up']} days, down {values['down']} days, "
+          f"return{RETURN_N} {(values[f'return{RETURN_N}'] * 100):.2f}%")
 
 
 if __name__ == '__main__':
@@ -126,10 +359,17 @@ if __name__ == '__main__':
     group.add_argument("-g", "--generate", type=str, metavar=('folder','database'), nargs=2, help="input folder and database name")
     group.add_argument("-a", "--append", type=str, metavar=('file','database'), nargs=2, help="input file and database name")
     group.add_argument("-s", "--search", metavar=('days', 'up or down','database'), nargs=3, help="input search condition")
+    group.add_argument("-k", "--streak", metavar=('days', 'up or down', 'database'), nargs=3, help="up or down at least days in a row")
+    group.add_argument("-r", "--return", dest="ret", metavar=('days', 'percent', 'database'), nargs=3, help="return over days at least percent, at most when negative")
+    group.add_argument("-t", "--top", metavar=('days', 'k', 'database'), nargs=3, help="k biggest moves either way over days")
+    group.add_argument("-i", "--indicators", metavar=('code', 'database'), nargs=2, help="indicators of one stock")
+    group.add_argument("-u", "--update", metavar='database', help="fetch the new klines of the stocks in the daily csv files into a .kline store")
+    parser.add_argument("-p", "--prune", type=int, metavar="DAYS", help="-u skips stocks not in the last DAYS daily files")
+    parser.add_argument("-j", "--jobs", type=int, help="processes parsing kline files for -g, 0 for none")
     args = parser.parse_args()
     if args.generate:
         print(args.generate)
-        generate_base(*args.generate)
+        generate_base(*args.generate, args.jobs)
     elif args.append:
         print(args.append)
         append_one_day(*args.append)
@@ -137,3 +377,20 @@ if __name__ == '__main__':
         print(args.search)
         search_last_n(int(args.search[0]), bool(
             int(args.search[1])), args.search[2])
+    elif args.streak:
+        print(args.streak)
+        search_streak(int(args.streak[0]), bool(
+            int(args.streak[1])), args.streak[2])
+    elif args.ret:
+        print(args.ret)
+        search_return(int(args.ret[0]), float(
+            args.ret[1]) / 100, args.ret[2])
+    elif args.top:
+        print(args.top)
+        search_top(int(args.top[0]), int(args.top[1]), args.top[2])
+    elif args.update:
+        print(args.update)
+        update_store(args.update, prune_days=args.prune)
+    elif args.indicators:
+        print(args.indicators)
+        show_indicators(*args.indicators)
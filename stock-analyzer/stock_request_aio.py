@@ -1,19 +1,49 @@
 import argparse
 import asyncio
+import csv
 import glob
-import itertools
 import json
 import operator
 import os
+import random
 import re
-import sys
 import time
 
 import aiohttp
+import numpy as np
 from tqdm import tqdm
 
+from symbol_registry import SymbolRegistry
+
 KEEP_N = 30
 
+HOST = "http://zzw.hsmdb.com"
+DAILY_URL = "/iwin_zzbweb-webapp/quote/v1/sort?en_hq_type_code=SS.ESA.M,SZ.ESA&sort_field_name=px_change_rate&data_count={}&sort_type=1&fields=prod_name,last_px,business_amount,current_amount,preclose_px,open_px,high_px,low_px,vol_ratio,business_balance,px_change,hq_type_code,px_change_rate&start_pos={}"
+KLINE_URL = "/iwin_zzbweb-webapp/quote/v1/kline?get_type=range&prod_code={}&candle_period=6&fields=open_px,high_px,low_px,close_px,business_amount"
+# narrows KLINE_URL down to the days from a yyyymmdd on
+KLINE_SINCE = "&start_date={}"
+
+# requests in flight adapt between MIN_CONCURRENCY and MAX_CONCURRENCY
+START_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+# overloaded when the smoothed latency is this many times its best, or when
+# more than ERROR_RATE of the recent requests failed. a 429 always counts
+SLOW_FACTOR = 3
+ERROR_RATE = 0.1
+SMOOTHING = 0.05
+RETRIES = 5
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 10
+RETRY_STATUS = {429, 500, 502, 503, 504}
+PAGE_SIZE = 100
+PAGE_COUNT = 39
+# the daily quotes as one array per column, read without parsing any text
+BUNDLE_SUFFIX = ".npz"
+REQUEST_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 600
+
 
 def shorten(src_folder, dst_folder):
     '''
@@ -36,22 +66,18 @@ def shorten(src_folder, dst_folder):
     bar.close()
 
 
-def collect_names():
-    csv_files = glob.glob("*.csv")
-    names_set = set()
-    for fn in csv_files:
-        try:
-            with open(fn, encoding="utf-8") as f:
-                cnt = 0
-                current_name_set = set()
-                for line in itertools.islice(f, 1, sys.maxsize):
-                    arr = line.split(",")
-                    current_name_set.add((arr[0], arr[4]))
-                    cnt += 1
-                names_set |= current_name_set
-        except Exception:
-            print(f"handle file {fn} mistake")
-    return names_set
+def collect_names(prune_days=None):
+    '''
+    (code, name) of every stock in the daily csv files of the cwd, only new
+    files are read. with prune_days stocks not in the last prune_days daily
+    files are skipped, the registry keeps them
+    '''
+    with SymbolRegistry() as registry:
+        registry.update(glob.glob("*.csv"))
+        names = registry.names(prune_days)
+        if prune_days:
+            print(f"skipped {len(registry.names()) - len(names)} stocks")
+        return set(names)
 
 
 def get_today_format_str():
@@ -59,93 +85,230 @@ def get_today_format_str():
     return time.strftime("%Y%m%d", t)
 
 
-def merge_to_file(fh, obj, first):
-    fmt = ''
+def page_rows(obj):
     data = obj["data"]["sort"]
+    for k, v in data.items():
+        if k != "fields":
+            yield [k, *v]
 
-    # if k == "fields":
-    def gen_fmt():
-        fmt = "{0}"
-        for idx, _ in enumerate(v, 1):
-            fmt += ",{" + str(idx) + "}"
-        return fmt
 
-    for k, v in data.items():
-        if fmt == '':
-            fmt = gen_fmt()
+def save_bundle(path, header, rows):
+    '''
+    save rows as one array per column of header in a compressed npz,
+    float64 where the column is all numbers
+    '''
+    columns = {}
+    for key, column in zip(header, zip(*rows)):
+        try:
+            columns[key] = np.array(column, dtype=np.float64)
+        except (TypeError, ValueError):
+            columns[key] = np.array(column, dtype=str)
+    np.savez_compressed(path, **columns)
 
-        # output title line only in first == true
-        if first:
-            first = False
-            fmt_data = fmt.format("code", *data["fields"])
-            print(fmt_data, file=fh)
 
-        if k != "fields":
-            fmt_data = fmt.format(k, *v)
-            print(fmt_data, file=fh)
+class FetchError(Exception):
+    pass
 
 
-async def fetch(session, url):
-    async with session.get(url) as response:
-        text = await response.text()
-        # print(text)
-        return json.loads(text)
+class AdaptiveLimit:
+    '''
+    lets at most limit requests run at once. limit grows by one after limit
+    good responses and halves when the server looks overloaded, at most once
+    per round trip, like the congestion window of tcp
+    '''
 
+    def __init__(self, limit=START_CONCURRENCY, low=MIN_CONCURRENCY,
+                 high=MAX_CONCURRENCY):
+        self.limit = limit
+        self.low = low
+        self.high = high
+        self.active = 0
+        self.good = 0
+        self.latency = None
+        self.best = None
+        self.errors = 0
+        self.last_cut = 0
+        self.cond = asyncio.Condition()
 
-async def request_daily():
-    async with aiohttp.ClientSession() as session:
-        url = 'http://zzw.hsmdb.com/iwin_zzbweb-webapp/quote/v1/sort?en_hq_type_code=SS.ESA.M,SZ.ESA&sort_field_name=px_change_rate&data_count={}&sort_type=1&fields=prod_name,last_px,business_amount,current_amount,preclose_px,open_px,high_px,low_px,vol_ratio,business_balance,px_change,hq_type_code,px_change_rate&start_pos={}'
-        page_size = 100
-        page_count = 39
+    async def __aenter__(self):
+        async with self.cond:
+            while self.active >= self.limit:
+                await self.cond.wait()
+            self.active += 1
+        return time.monotonic()
 
-        name = get_today_format_str()
-        start_time = time.perf_counter()
-        tasks = []
-        for i in range(page_count):
-            req_url = url.format(page_size, i * page_size)
-            task = asyncio.create_task(fetch(session, req_url))
-            tasks.append(task)
-        results = await asyncio.gather(*tasks)
-        with open(f"{name}_aio.csv", "w", encoding="utf-8") as f:
-            for i, result in enumerate(results):
-                merge_to_file(f, result, i == 0)
-        print("Cost time : ", time.perf_counter() - start_time)
-
-
-async def request_kline(names):
-    async with aiohttp.ClientSession() as session:
-        url = "http://zzw.hsmdb.com/iwin_zzbweb-webapp/quote/v1/kline?get_type=range&prod_code={}&candle_period=6&fields=open_px,high_px,low_px,close_px,business_amount"
-
-        folder = get_today_format_str()
-        os.makedirs(folder, exist_ok=True)
-
-        tasks = []
-        for name in names:
-            req_url = url.format(name)
-            task = asyncio.create_task(fetch(session, req_url))
-            tasks.append(task)
-        # results = await asyncio.gather(*tasks)
-        # for result in results:
-        bar = tqdm(total=len(tasks))
-        for future in asyncio.as_completed(tasks):
-            result = await future
+    async def __aexit__(self, *exc_info):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify(max(self.limit - self.active, 0))
+
+    def record(self, start, ok, throttled=False):
+        latency = time.monotonic() - start
+        self.errors += SMOOTHING * ((not ok) - self.errors)
+        if ok:
+            if self.latency is None:
+                self.latency = latency
+            self.latency += SMOOTHING * (latency - self.latency)
+            if self.best is None or self.latency < self.best:
+                self.best = self.latency
+        overloaded = (throttled or self.errors > ERROR_RATE or
+                      (ok and self.latency > SLOW_FACTOR * self.best))
+        if not overloaded:
+            self.good += ok
+            if self.good >= self.limit:
+                self.good = 0
+                self.limit = min(self.limit + 1, self.high)
+        # requests sent before the last cut saw the old limit, they do not
+        # cut it again
+        elif start >= self.last_cut:
+            self.good = 0
+            self.limit = max(self.limit // 2, self.low)
+            self.last_cut = time.monotonic()
+
+
+def backoff(attempt, retry_after=None):
+    # full jitter, but never sooner than the server asked for
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        return delay
+
+
+def client_session():
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY,
+                                     limit_per_host=MAX_CONCURRENCY,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                     ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+
+
+async def fetch_retry(session, url, limit):
+    '''
+    fetch json from url within limit, retrying throttling, server errors and
+    timeouts with backoff
+    '''
+    for attempt in range(RETRIES):
+        retry_after = None
+        async with limit as start:
+            try:
+                async with session.get(url) as response:
+                    if response.status in RETRY_STATUS:
+                        error = f"HTTP {response.status}"
+                        retry_after = response.headers.get("Retry-After")
+                    elif response.status >= 400:
+                        limit.record(start, True)
+                        raise FetchError(f"{url}: HTTP {response.status}")
+                    else:
+                        text = await response.text()
+                        limit.record(start, True)
+                        return json.loads(text)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            limit.record(start, False, error == "HTTP 429")
+        await asyncio.sleep(backoff(attempt, retry_after))
+    raise FetchError(f"{url}: {error} after {RETRIES} tries")
+
+
+async def request_daily(host=HOST, bundle=False):
+    name = get_today_format_str()
+    start_time = time.perf_counter()
+    limit = AdaptiveLimit()
+    kept = []
+    async with client_session() as session:
+        tasks = [asyncio.create_task(fetch_retry(
+            session, host + DAILY_URL.format(PAGE_SIZE, i * PAGE_SIZE), limit))
+            for i in range(PAGE_COUNT)]
+        try:
+            with open(f"{name}_aio.csv", "w", encoding="utf-8",
+                      newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                # pages go out in order, each as soon as it and the ones
+                # before it have arrived
+                for i, task in enumerate(tasks):
+                    result = await task
+                    if i == 0:
+                        header = ["code", *result["data"]["sort"]["fields"]]
+                        writer.writerow(header)
+                    rows = list(page_rows(result))
+                    writer.writerows(rows)
+                    if bundle:
+                        kept.extend(rows)
+        finally:
+            for task in tasks:
+                task.cancel()
+    if bundle:
+        save_bundle(name + "_aio" + BUNDLE_SUFFIX, header, kept)
+    print("Cost time : ", time.perf_counter() - start_time)
+
+
+def candle_of(result):
+    # the name and [date, open, high, low, close, amount] rows of a kline
+    candle = result["data"]["candle"]
+    name = list(candle.keys())[1]
+    return name, candle[name]
+
+
+async def fetch_klines(jobs, handle):
+    '''
+    fetch the kline of every (name, url) of jobs and handle(name, result)
+    each, names that failed are returned
+    '''
+    limit = AdaptiveLimit()
+    # workers share one iterator, the limit decides how many of them wait
+    # on the server at once
+    pending = iter(jobs)
+    failed = []
+    bar = tqdm(total=len(jobs))
+
+    async def worker(session):
+        for name, url in pending:
+            try:
+                handle(name, await fetch_retry(session, url, limit))
+            except (FetchError, KeyError, IndexError, TypeError,
+                    ValueError) as e:
+                failed.append(name)
+                bar.write(f"fail to fetch {name}: {e}")
             bar.update(1)
-            candle = result["data"]["candle"]
-            name = list(candle.keys())[1]
-            with open(f"{folder}/{name}.json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(candle[name]))
-        bar.close()
+
+    async with client_session() as session:
+        await asyncio.gather(*(worker(session)
+                               for _ in range(MAX_CONCURRENCY)))
+    bar.close()
+    print(f"{len(jobs) - len(failed)} fetched, {len(failed)} failed, "
+          f"ended at {limit.limit} requests at once")
+    return failed
+
+
+async def request_kline(names, host=HOST):
+    folder = get_today_format_str()
+    os.makedirs(folder, exist_ok=True)
+
+    def save(_, result):
+        name, kline = candle_of(result)
+        with open(f"{folder}/{name}.json", "w", encoding="utf-8") as f:
+            f.write(json.dumps(kline))
+
+    jobs = [(name, host + KLINE_URL.format(name)) for name in names]
+    return await fetch_klines(jobs, save)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--daily", action="store_true")
     parser.add_argument("-t", "--total", action="store_true")
+    parser.add_argument("-b", "--bundle", action="store_true",
+                        help="also save the daily quotes as an npz bundle")
+    parser.add_argument("-p", "--prune", type=int, metavar="DAYS",
+                        help="skip stocks not in the last DAYS daily files")
     args = parser.parse_args()
     if args.daily:
-        asyncio.run(request_daily())
+        asyncio.run(request_daily(bundle=args.bundle))
     if args.total:
-        asyncio.run(request_daily())
-        names = collect_names()
+        asyncio.run(request_daily(bundle=args.bundle))
+        names = collect_names(args.prune)
         names = map(operator.itemgetter(0), names)
         asyncio.run(request_kline(names))
         print("start to shorten ...")
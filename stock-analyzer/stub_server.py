@@ -0,0 +1,214 @@
+'''
+a local stand in for the quote server, slow and unreliable on purpose
+
+python stub_server.py -p 8080                 # serve until ctrl-c
+python stub_server.py -n 4000 -c 24 -e 0.05   # fetch 4000 klines against it
+python stub_server.py -d                      # fetch the daily quotes
+python stub_server.py -u                      # daily quotes, then -u twice
+'''
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from aiohttp import web
+
+from stock_database import update_store
+from stock_request_aio import (BUNDLE_SUFFIX, PAGE_COUNT, PAGE_SIZE,
+                               get_today_format_str, request_daily,
+                               request_kline)
+
+
+class Stub:
+    '''
+    every request takes latency seconds plus load * latency for each request
+    already in flight. above capacity in flight it answers 429, and a
+    error_rate share of the others get a 500 or 503
+    '''
+
+    def __init__(self, latency, capacity, error_rate):
+        self.latency = latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self.counts = {}
+
+    def count(self, status):
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+    async def trouble(self):
+        # an error response, or None after the latency of a good one
+        if self.in_flight >= self.capacity:
+            self.count(429)
+            return web.Response(status=429, headers={"Retry-After": "0.1"})
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(random.expovariate(1 / self.latency) +
+                                self.latency * self.in_flight / 4)
+        finally:
+            self.in_flight -= 1
+        if random.random() < self.error_rate:
+            status = random.choice((500, 503))
+            self.count(status)
+            return web.Response(status=status)
+        self.count(200)
+        return None
+
+    async def sort(self, request):
+        response = await self.trouble()
+        if response:
+            return response
+        fields = request.query["fields"].split(",")
+        start = int(request.query["start_pos"])
+        count = int(request.query["data_count"])
+        data = {"fields": fields}
+        for i in range(start, min(start + count, PAGE_SIZE * PAGE_COUNT)):
+            code = f"{600000 + i}.SS"
+            rnd = random.Random(code)
+            data[code] = [f"stock {i}" if field == "prod_name" else
+                          "SS.ESA.M" if field == "hq_type_code" else
+                          round(rnd.uniform(1, 100), 2) for field in fields]
+        return web.json_response({"data": {"sort": data}})
+
+    async def kline(self, request):
+        response = await self.trouble()
+        if response:
+            return response
+        code = request.query["prod_code"]
+        since = int(request.query.get("start_date", 0))
+        kline = [row for row in fake_kline(code) if row[0] >= since]
+        return web.json_response({"data": {"candle": {
+            "fields": ["min_time", "open_px", "high_px", "low_px",
+                       "close_px", "business_amount"],
+            code: kline}}})
+
+
+def fake_kline(code, days=60):
+    rnd = random.Random(code)
+    price = rnd.uniform(5, 50)
+    kline = []
+    for day in range(days):
+        price = round(price * rnd.uniform(0.95, 1.05), 2)
+        kline.append([20200401 + day, price, price, price, price,
+                      rnd.randrange(100000)])
+    return kline
+
+
+def make_app(stub):
+    app = web.Application()
+    app.router.add_get("/iwin_zzbweb-webapp/quote/v1/kline", stub.kline)
+    app.router.add_get("/iwin_zzbweb-webapp/quote/v1/sort", stub.sort)
+    return app
+
+
+async def serve(stub, port):
+    runner = web.AppRunner(make_app(stub))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def bench_daily(stub, port):
+    runner = await serve(stub, port)
+    name = get_today_format_str() + "_aio"
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                await request_daily(f"http://127.0.0.1:{port}", bundle=True)
+                for suffix in (".csv", BUNDLE_SUFFIX):
+                    print(name + suffix, os.path.getsize(name + suffix),
+                          "bytes")
+            finally:
+                os.chdir(cwd)
+    finally:
+        await runner.cleanup()
+    print("server answered", dict(sorted(stub.counts.items())))
+
+
+async def bench_update(stub, port):
+    runner = await serve(stub, port)
+    host = f"http://127.0.0.1:{port}"
+    loop = asyncio.get_running_loop()
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                await request_daily(host)
+                # update_store runs a loop of its own
+                for _ in range(2):
+                    stub.counts.clear()
+                    start = time.perf_counter()
+                    await loop.run_in_executor(
+                        None, update_store, "stocks.kline", host)
+                    print(f"update took {time.perf_counter() - start:.2f}s, "
+                          f"server answered",
+                          dict(sorted(stub.counts.items())))
+            finally:
+                os.chdir(cwd)
+    finally:
+        await runner.cleanup()
+
+
+async def bench(stub, port, count):
+    runner = await serve(stub, port)
+    names = [f"{600000 + i}.SS" for i in range(count)]
+    cwd = os.getcwd()
+    try:
+        # request_kline writes to a folder of today under the cwd
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                start = time.perf_counter()
+                failed = await request_kline(names,
+                                             f"http://127.0.0.1:{port}")
+                take = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+    finally:
+        await runner.cleanup()
+    print(f"{count - len(failed)} klines in {take:.2f}s, "
+          f"{(count - len(failed)) / take:.0f}/s")
+    print("server answered", dict(sorted(stub.counts.items())))
+
+
+async def run_forever(stub, port):
+    await serve(stub, port)
+    print(f"serving on 127.0.0.1:{port}")
+    while(1):
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-l", "--latency", type=float, default=0.02,
+                        help="mean seconds per request when idle")
+    parser.add_argument("-c", "--capacity", type=int, default=32,
+                        help="requests in flight before answering 429")
+    parser.add_argument("-e", "--error-rate", type=float, default=0.02,
+                        help="share of 500/503 answers")
+    parser.add_argument("-n", "--count", type=int,
+                        help="fetch this many klines from the stub and exit")
+    parser.add_argument("-d", "--daily", action="store_true",
+                        help="fetch the daily quotes from the stub and exit")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="fetch the daily quotes, then update a .kline "
+                        "store from the stub twice")
+    args = parser.parse_args()
+    stub = Stub(args.latency, args.capacity, args.error_rate)
+    if args.daily:
+        asyncio.run(bench_daily(stub, args.port))
+    elif args.update:
+        asyncio.run(bench_update(stub, args.port))
+    elif args.count:
+        asyncio.run(bench(stub, args.port, args.count))
+    else:
+        try:
+            asyncio.run(run_forever(stub, args.port))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,118 @@
+'''
+every stock seen in the daily csv files with the first and last day it was
+seen, kept in sqlite so that each daily file is read only once
+'''
+
+import csv
+import os
+import re
+import sqlite3
+
+REGISTRY = "symbols.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS symbols (
+    code TEXT PRIMARY KEY,
+    name TEXT,
+    first_seen INTEGER,
+    last_seen INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    day INTEGER,
+    size INTEGER,
+    mtime REAL
+);
+"""
+
+# a file read again (or out of order) only ever widens the seen range
+UPSERT = """
+INSERT INTO symbols (code, name, first_seen, last_seen) VALUES (?, ?, ?, ?)
+ON CONFLICT (code) DO UPDATE SET
+    name = CASE WHEN excluded.last_seen >= last_seen
+           THEN coalesce(excluded.name, name) ELSE name END,
+    first_seen = min(first_seen, excluded.first_seen),
+    last_seen = max(last_seen, excluded.last_seen)
+"""
+
+
+def day_of(day_file):
+    return int(re.split(r"[^\d]", os.path.basename(day_file))[0])
+
+
+class SymbolRegistry:
+    def __init__(self, path=REGISTRY):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_file(self, day_file):
+        '''
+        record the stocks of a daily csv, unless it was added before and has
+        not changed since. True when it was read
+        '''
+        key = os.path.abspath(day_file)
+        stat = os.stat(day_file)
+        seen = self.db.execute("SELECT size, mtime FROM files WHERE file = ?",
+                               (key,)).fetchone()
+        if seen == (stat.st_size, stat.st_mtime):
+            return False
+        day = day_of(day_file)
+        with open(day_file, encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            code = header.index("code")
+            name = header.index("prod_name") if "prod_name" in header else None
+            rows = ((row[code], row[name] if name is not None else None,
+                     day, day) for row in reader if row)
+            # one transaction per file, a broken file leaves no trace
+            with self.db:
+                self.db.executemany(UPSERT, rows)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (key, day, stat.st_size, stat.st_mtime))
+        return True
+
+    def update(self, day_files):
+        added = 0
+        for fn in day_files:
+            try:
+                added += self.add_file(fn)
+            except (OSError, ValueError, IndexError, StopIteration,
+                    csv.Error, sqlite3.Error):
+                print(f"handle file {fn} mistake")
+        return added
+
+    def cutoff(self, days):
+        # the oldest of the last days daily files, None if there are fewer
+        row = self.db.execute(
+            "SELECT DISTINCT day FROM files ORDER BY day DESC LIMIT 1 "
+            "OFFSET ?", (days - 1,)).fetchone()
+        return row and row[0]
+
+    def names(self, days=None):
+        '''
+        (code, name) of the stocks, with days only those seen in the last days
+        daily files. the others are kept and come back once days is widened
+        '''
+        cutoff = self.cutoff(days) if days else None
+        if cutoff is None:
+            return self.db.execute(
+                "SELECT code, name FROM symbols ORDER BY code").fetchall()
+        return self.db.execute(
+            "SELECT code, name FROM symbols WHERE last_seen >= ? "
+            "ORDER BY code", (cutoff,)).fetchall()
+
+    def seen(self, code):
+        # (first_seen, last_seen) of code, None if never seen
+        return self.db.execute(
+            "SELECT first_seen, last_seen FROM symbols WHERE code = ?",
+            (code,)).fetchone()